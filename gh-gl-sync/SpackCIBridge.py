@@ -4,16 +4,32 @@ from __future__ import annotations
 import argparse
 import atexit
 import base64
+import boto3
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from datetime import datetime, timedelta, timezone
 import dateutil.parser
-from github import Github
+from github import Github, GithubException
+from github.Requester import HTTPSRequestsConnectionClass, Requester, RequestsResponse
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
 import json
 import os
 import re
+import requests
 import sentry_sdk
+import shutil
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from types import SimpleNamespace
 import urllib.parse
 import urllib.request
 
@@ -24,6 +40,441 @@ if 'SENTRY_DSN' in os.environ:
     )
 
 
+class RunMetrics(object):
+    """How long each phase of a sync took, and counters of what it did.
+    Phases can be nested, and the time spent in a phase is added up over every time it runs.
+    Each phase is also reported to Sentry as a span of the current transaction, if there is one.
+    """
+    COUNTERS = ("github_requests", "github_not_modified", "gitlab_requests", "git_commands",
+                "bytes_fetched", "bytes_pushed")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Set by uncounted() for the thread running commands that only serve the metrics themselves.
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.phases: dict[str, float] = {}
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            with sentry_sdk.start_span(op="bridge.phase", description=name):
+                yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    @contextlib.contextmanager
+    def uncounted(self):
+        """Don't count the git commands the body runs, for commands the metrics need to measure something."""
+        self.local.uncounted = True
+        try:
+            yield
+        finally:
+            self.local.uncounted = False
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "duration": round(time.monotonic() - self.started, 3),
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+
+run_metrics = RunMetrics()
+
+
+def count_git_commands(event, args):
+    """Audit hook that counts every git process we start, however it gets started."""
+    if event == "subprocess.Popen":
+        command = args[1] if isinstance(args[1], (list, tuple)) else [args[1]]
+        if os.path.basename(str(command[0])) == "git" and not getattr(run_metrics.local, "uncounted", False):
+            run_metrics.count("git_commands")
+
+
+sys.addaudithook(count_git_commands)
+
+
+class GithubResponseCache(object):
+    """GitHub API responses by URL, along with the ETag and Last-Modified headers to check if they changed.
+    Responses are also kept in the state file, if the bridge has one, so later runs can reuse them.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.lock = threading.Lock()
+        self.state = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> dict | None:
+        with self.lock:
+            if url in self.entries:
+                self.entries.move_to_end(url)
+                return self.entries[url]
+        return self.state.get_response(url) if self.state else None
+
+    def put(self, url: str, entry: dict):
+        with self.lock:
+            self.entries[url] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.state:
+            self.state.set_response(url, entry)
+
+    def count(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class GithubConnection(HTTPSRequestsConnectionClass):
+    """By default PyGithub sends every request through one shared connection object, which is not
+    thread-safe. This connection class gets instantiated for each request instead, and all
+    instances share one pool of keep-alive connections.
+
+    GET requests are made conditional on the response having changed since we last saw it.
+    GitHub doesn't count "304 Not Modified" responses against the rate limit, and we hand
+    the response we saw before to PyGithub instead.
+    """
+    shared_session = requests.Session()
+    shared_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+    response_cache = GithubResponseCache()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = self.shared_session
+
+    def getresponse(self):
+        run_metrics.count("github_requests")
+        if self.verb != "GET":
+            return super().getresponse()
+
+        cached = self.response_cache.get(self.url)
+        if cached:
+            self.headers = dict(self.headers)
+            if cached["etag"]:
+                self.headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                self.headers["If-Modified-Since"] = cached["last_modified"]
+        response = super().getresponse()
+
+        if response.status == 304 and cached:
+            self.response_cache.count(hit=True)
+            run_metrics.count("github_not_modified")
+            # Keep the rate limit headers of the new response.
+            headers = requests.structures.CaseInsensitiveDict(cached["headers"])
+            headers.update(response.headers)
+            return RequestsResponse(SimpleNamespace(status_code=200, headers=headers, text=cached["text"]))
+
+        self.response_cache.count(hit=False)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status == 200 and (etag or last_modified):
+            self.response_cache.put(self.url, {
+                "etag": etag,
+                "last_modified": last_modified,
+                "headers": dict(response.headers),
+                "text": response.text,
+            })
+        return response
+
+
+Requester.injectConnectionClasses(GithubConnection, GithubConnection)
+
+
+# Git asks this for the credentials to GitHub, so GITHUB_TOKEN is read from the environment every time
+# instead of being written into the repository with the URL of the github remote.
+GITHUB_CREDENTIAL_HELPER = \
+    '!f() { test "$1" = get && echo username=x-access-token && echo "password=$GITHUB_TOKEN"; }; f'
+
+
+# Everything list_github_prs() and create_status_for_commit() need to know about the open PRs,
+# fetched 50 PRs at a time. %(check_suites)s is filled in by SpackCIBridge.open_prs_query().
+OPEN_PRS_QUERY = """
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, first: 50, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        isDraft
+        updatedAt
+        mergeable
+        headRefName
+        headRefOid
+        baseRefName
+        baseRefOid
+        potentialMergeCommit { oid }
+        commits(last: 1) {
+          nodes {
+            commit {
+              %(check_suites)s
+              status { contexts { context state description targetUrl } }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class BridgeState(object):
+    """What earlier runs of the bridge did, kept in an SQLite database so that later runs
+    can skip the git commands and API calls needed to work it out again.
+
+    For each PR branch we record the head SHA we last made a decision about, the latest tested
+    main branch commit it was checked against, and the verdict: "pushed", "unmergeable", or
+    "base" (merge-base newer than the latest tested main commit). For each commit we record the
+    last status we posted to it, and for pairs of commits whether one is an ancestor of the other.
+    GitHub API responses are kept too, see GithubResponseCache.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS prs (
+                pr_string TEXT PRIMARY KEY,
+                head_sha TEXT NOT NULL,
+                main_sha TEXT,
+                verdict TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ancestry (
+                ancestor TEXT NOT NULL,
+                descendant TEXT NOT NULL,
+                is_ancestor INTEGER NOT NULL,
+                checked_at REAL NOT NULL,
+                PRIMARY KEY (ancestor, descendant)
+            );
+            CREATE TABLE IF NOT EXISTS github_responses (
+                url TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS statuses (
+                sha TEXT NOT NULL,
+                context TEXT NOT NULL,
+                state TEXT NOT NULL,
+                target_url TEXT NOT NULL,
+                description TEXT NOT NULL,
+                posted_at REAL NOT NULL,
+                PRIMARY KEY (sha, context)
+            );
+        """)
+        # Statuses and ancestry are only looked up for commits that are still being tested.
+        with self.lock:
+            self.db.execute("DELETE FROM statuses WHERE posted_at < ?", (time.time() - 30 * 86400,))
+            self.db.execute("DELETE FROM ancestry WHERE checked_at < ?", (time.time() - 30 * 86400,))
+            self.db.execute("DELETE FROM github_responses WHERE used_at < ?", (time.time() - 7 * 86400,))
+
+    def get_pr(self, pr_string: str) -> tuple[str, str | None, str] | None:
+        """Return (head_sha, main_sha, verdict) recorded for a PR branch, if any."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT head_sha, main_sha, verdict FROM prs WHERE pr_string = ?", (pr_string,)).fetchone()
+
+    def set_pr(self, pr_string: str, head_sha: str, main_sha: str | None, verdict: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO prs VALUES (?, ?, ?, ?)",
+                            (pr_string, head_sha, main_sha, verdict))
+
+    def forget_closed_prs(self, open_pr_strings):
+        """Drop the records of PR branches that are no longer open."""
+        with self.lock:
+            recorded = [row[0] for row in self.db.execute("SELECT pr_string FROM prs")]
+            closed = set(recorded) - set(open_pr_strings)
+            self.db.executemany("DELETE FROM prs WHERE pr_string = ?", [(pr,) for pr in closed])
+
+    def get_ancestry(self, ancestor: str, descendant: str) -> bool | None:
+        """Return whether ancestor was found to be an ancestor of descendant, if we checked before."""
+        with self.lock:
+            row = self.db.execute("SELECT is_ancestor FROM ancestry WHERE ancestor = ? AND descendant = ?",
+                                  (ancestor, descendant)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def set_ancestry(self, results: dict[tuple[str, str], bool]):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO ancestry VALUES (?, ?, ?, ?)",
+                                [(ancestor, descendant, int(result), now)
+                                 for (ancestor, descendant), result in results.items()])
+
+    def get_response(self, url: str) -> dict | None:
+        """Return the GitHub API response we last got for a URL, if any."""
+        with self.lock:
+            row = self.db.execute("SELECT response FROM github_responses WHERE url = ?", (url,)).fetchone()
+            if row:
+                self.db.execute("UPDATE github_responses SET used_at = ? WHERE url = ?", (time.time(), url))
+        return json.loads(row[0]) if row else None
+
+    def set_response(self, url: str, response: dict):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO github_responses VALUES (?, ?, ?)",
+                            (url, json.dumps(response), time.time()))
+
+    def get_status(self, sha: str, context: str) -> tuple[str, str, str] | None:
+        """Return (state, target_url, description) of the last status we posted to a commit, if any."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT state, target_url, description FROM statuses WHERE sha = ? AND context = ?",
+                (sha, context)).fetchone()
+
+    def set_status(self, sha: str, context: str, state: str, target_url: str, description: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO statuses VALUES (?, ?, ?, ?, ?, ?)",
+                            (sha, context, state, target_url, description, time.time()))
+
+
+class DebouncedQueue(object):
+    """Queue of things for the bridge to sync. An item is only queued once no matter how many
+    events arrive for it, and it is handed out once no new event for it arrived for `delay` seconds,
+    or `max_delay` seconds after its first event at the latest.
+    """
+
+    def __init__(self, delay: float, max_delay: float | None = None):
+        self.delay = delay
+        self.max_delay = max_delay if max_delay is not None else 6 * delay
+        # item -> (time of its first event, time it's due)
+        self.pending: dict[tuple, tuple[float, float]] = {}
+        self.condition = threading.Condition()
+
+    def put(self, item: tuple):
+        now = time.monotonic()
+        with self.condition:
+            first_event = self.pending[item][0] if item in self.pending else now
+            self.pending[item] = (first_event, min(now + self.delay, first_event + self.max_delay))
+            self.condition.notify()
+
+    def get(self, timeout: float) -> tuple | None:
+        """Return the next item that is due, or None if no item becomes due within timeout seconds."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wake_up = deadline
+                if self.pending:
+                    item, (first_event, due) = min(self.pending.items(), key=lambda entry: entry[1][1])
+                    if due <= now:
+                        del self.pending[item]
+                        return item
+                    wake_up = min(due, deadline)
+                if wake_up <= now:
+                    return None
+                self.condition.wait(wake_up - now)
+
+    def clear(self):
+        with self.condition:
+            self.pending.clear()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives GitHub and GitLab webhooks, and queues what they are about for the bridge to sync.
+    The server it belongs to needs `bridge` and `queue` attributes.
+    """
+
+    def do_GET(self):
+        self.respond(200, {"status": "ok"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "X-GitHub-Event" in self.headers:
+            source, event = "github", self.headers["X-GitHub-Event"]
+            # Without a secret to check the signature against, nothing gets through.
+            secret = os.environ.get("GITHUB_WEBHOOK_SECRET", "")
+            signature = "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            if not secret or not hmac.compare_digest(signature, self.headers.get("X-Hub-Signature-256", "")):
+                return self.respond(401, {"error": "Invalid signature"})
+        elif "X-Gitlab-Event" in self.headers:
+            source, event = "gitlab", self.headers["X-Gitlab-Event"]
+            token = os.environ.get("GITLAB_WEBHOOK_TOKEN", "")
+            if not token or not hmac.compare_digest(token, self.headers.get("X-Gitlab-Token", "")):
+                return self.respond(401, {"error": "Invalid token"})
+        else:
+            return self.respond(400, {"error": "Not a GitHub or GitLab webhook"})
+
+        try:
+            items = self.server.bridge.webhook_items(source, event, json.loads(body))
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, AttributeError):
+            return self.respond(400, {"error": "Invalid payload"})
+        for item in items:
+            self.server.queue.put(item)
+        self.respond(202, {"queued": len(items)})
+
+    def respond(self, code: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PerThreadStdout(io.TextIOBase):
+    """Stand-in for sys.stdout that lets worker threads collect their output in a buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer or self.stream).write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run_grouped(func, items, max_workers):
+    """Call func on each item concurrently.
+    Everything printed by one call is printed as a single block, in the order of items."""
+    real_stdout = sys.stdout
+    proxy = PerThreadStdout(real_stdout)
+
+    def call(item):
+        proxy.local.buffer = io.StringIO()
+        try:
+            func(item)
+        finally:
+            output = proxy.local.buffer.getvalue()
+            proxy.local.buffer = None
+        return output
+
+    sys.stdout = proxy
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for output in executor.map(call, items):
+                real_stdout.write(output)
+    finally:
+        sys.stdout = real_stdout
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """Parse a timestamp from the GitLab API, like 2020-08-26T17:26:36.807Z.
+    datetime.fromisoformat() is much faster than dateutil, but only understands the "Z" suffix
+    from Python 3.11 on, and not every ISO 8601 format."""
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return dateutil.parser.parse(timestamp)
+
+
 class SpackCIBridge(object):
 
     def __init__(
@@ -36,15 +487,26 @@ class SpackCIBridge(object):
         sync_draft_prs: bool = False,
         main_branch: str | None = None,
         prereq_checks: list[str] = [],
+        status_workers: int = 8,
+        use_graphql: bool = False,
+        state_file: str | None = None,
+        git_mirror: str | None = None,
+        merge_workers: int | None = None,
+        push_workers: int = 4,
+        push_chunk_size: int = 100,
+        metrics_file: str | None = None,
+        pr_mirror_bucket: str | None = None,
     ):
         self.gitlab_repo = gitlab_repo
         self.github_project = github_project
         github_token = os.environ.get('GITHUB_TOKEN')
-        self.github_repo = "https://{0}@github.com/{1}.git".format(github_token, self.github_project)
+        self.github_token = github_token
+        self.github_repo = "https://github.com/{0}.git".format(self.github_project)
         self.py_github = Github(github_token)
         self.py_gh_repo = self.py_github.get_repo(self.github_project, lazy=True)
 
         self.merge_msg_regex = re.compile(r"Merge\s+([^\s]+)\s+into\s+([^\s]+)")
+        self.pr_branch_regex = re.compile(r"pr\d+_")
         self.unmergeable_shas = []
 
         self.post_status = not disable_status_post
@@ -55,6 +517,46 @@ class SpackCIBridge(object):
 
         self.prereq_checks = prereq_checks
 
+        # Number of PRs to merge into the latest tested main branch commit at once.
+        self.merge_workers = merge_workers or os.cpu_count() or 1
+
+        # Refs are pushed to GitLab in chunks of this many refs, with this many pushes at once.
+        self.push_workers = push_workers
+        self.push_chunk_size = push_chunk_size
+
+        # Where to write the timings and counters of each sync as JSON.
+        self.metrics_file = metrics_file
+
+        # S3 bucket with a mirror for each PR branch under a prefix of the same name.
+        self.pr_mirror_bucket = pr_mirror_bucket
+        # Every open PR branch, once list_github_prs() has looked at all open PRs.
+        self.open_pr_strings: list[str] | None = None
+
+        # Statuses are posted from this many threads at once. When GitHub's secondary rate limit
+        # is hit, all of them wait until github_backoff_until.
+        self.status_workers = status_workers
+        self.github_backoff_until = 0.0
+        self.github_backoff_lock = threading.Lock()
+
+        # When use_graphql is set, open PRs are listed with a single GraphQL query that also returns
+        # the check runs and statuses of their head commits, which are kept in commit_snapshots.
+        # GitHub's verdict on whether each PR can be merged is kept in pr_mergeable, by PR number.
+        self.use_graphql = use_graphql
+        self.github_graphql_url = "https://api.github.com/graphql"
+        self.commit_snapshots: dict[str, SimpleNamespace] = {}
+        self.pr_mergeable: dict[int, str] = {}
+
+        # Optional record of what earlier runs did. sync() changes directory, so resolve the path now.
+        self.state = None
+        if state_file:
+            self.state = BridgeState(state_file if state_file == ":memory:" else os.path.abspath(state_file))
+        GithubConnection.response_cache.state = self.state
+
+        # Without git_mirror every sync starts from a shallow clone in a temporary directory.
+        # With it we keep a full clone in that directory between runs and only fetch what is new.
+        self.git_mirror = os.path.abspath(git_mirror) if git_mirror else None
+        self.shallow = not self.git_mirror
+
         dt = datetime.now(timezone.utc) + timedelta(minutes=-60)
         self.time_threshold_brief = urllib.parse.quote_plus(dt.isoformat(timespec="seconds"))
 
@@ -63,12 +565,26 @@ class SpackCIBridge(object):
         self.pipeline_api_template += urllib.parse.quote_plus(gitlab_project)
         self.pipeline_api_template += "/pipelines?ref={0}"
 
+        self.project_pipelines_api = gitlab_host
+        self.project_pipelines_api += "/api/v4/projects/"
+        self.project_pipelines_api += urllib.parse.quote_plus(gitlab_project)
+        self.project_pipelines_api += "/pipelines"
+        self.recent_pipelines: dict[str, list[dict]] | None = None
+
         self.commit_api_template = gitlab_host
         self.commit_api_template += "/api/v4/projects/"
         self.commit_api_template += urllib.parse.quote_plus(gitlab_project)
         self.commit_api_template += "/repository/commits/{0}"
 
         self.cached_commits = {}
+        # The commit that each protected branch and tag points to on GitHub, by ref name.
+        self.github_ref_shas: dict[str, str] = {}
+        # The PR HEAD that each commit GitLab may test was made from, or None for commits that aren't
+        # merge commits, see index_tested_shas().
+        self.tested_sha_index: dict[str, str | None] = {}
+        # The refs that push_to_gitlab() gave up on pushing, see raise_for_unpushed_refs().
+        self.unpushed_refs: set[str] = set()
+        self.ancestry_cache: dict[tuple[str, str], bool] = {}
 
     @atexit.register
     def cleanup():
@@ -111,6 +627,23 @@ class SpackCIBridge(object):
             fp.seek(0)
             subprocess.run(["ssh-add", fp.name], check=True)
 
+    def reset_run_state(self):
+        """Forget what the previous sync found out about GitHub and GitLab, for a long running bridge."""
+        self.unmergeable_shas = []
+        self.currently_running_sha = None
+        self.latest_tested_main_commit = None
+        self.commit_snapshots = {}
+        self.cached_commits = {}
+        self.recent_pipelines = None
+        self.github_ref_shas = {}
+        self.tested_sha_index = {}
+        self.unpushed_refs = set()
+        self.open_pr_strings = None
+        GithubConnection.response_cache.hits = GithubConnection.response_cache.misses = 0
+        run_metrics.reset()
+        dt = datetime.now(timezone.utc) + timedelta(minutes=-60)
+        self.time_threshold_brief = urllib.parse.quote_plus(dt.isoformat(timespec="seconds"))
+
     def get_commit(self, commit):
         """ Check our cache for a commit on GitHub.
             If we don't have it yet, use the GitHub API to retrieve it."""
@@ -118,12 +651,132 @@ class SpackCIBridge(object):
             self.cached_commits[commit] = self.py_gh_repo.get_commit(sha=commit)
         return self.cached_commits[commit]
 
-    def list_github_prs(self):
-        """ Return two dicts of data about open PRs on GitHub:
-            one for all open PRs, and one for open PRs that are not up-to-date on GitLab."""
-        pr_dict = {}
+    def call_github(self, func, *args, **kwargs):
+        """ Call a PyGithub method, backing off and retrying when it trips
+            GitHub's secondary rate limit."""
+        for attempt in range(4):
+            delay = self.github_backoff_until - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                return func(*args, **kwargs)
+            except GithubException as e:
+                secondary_limit = e.status in (403, 429) and "secondary rate limit" in str(e.data).lower()
+                if not secondary_limit or attempt == 3:
+                    raise
+                # GitHub asks to wait for Retry-After seconds, or at least a minute if it's not given.
+                retry_after = int((e.headers or {}).get("retry-after", 60 * 2**attempt))
+                print("Hit GitHub's secondary rate limit, waiting {} seconds".format(retry_after))
+                with self.github_backoff_lock:
+                    self.github_backoff_until = max(self.github_backoff_until, time.time() + retry_after)
+
+    def open_prs_query(self):
+        """ Return the GraphQL query for open PRs. A workflow can have more check runs than fit on a page,
+            so only the runs of the prerequisite checks are asked for, with one filtered field for each."""
+        check_runs = " ".join(
+            "check{0}: checkRuns(first: 100, filterBy: {{checkName: {1}}}) {{ nodes {{ name conclusion }} }}"
+            .format(i, json.dumps(check)) for i, check in enumerate(self.prereq_checks or []))
+        check_suites = "checkSuites(first: 100) {{ nodes {{ {0} }} }}".format(check_runs) if check_runs else ""
+        return OPEN_PRS_QUERY % {"check_suites": check_suites}
+
+    def get_open_prs_graphql(self):
+        """ Return open PRs from GitHub's GraphQL API, shaped like PyGithub PullRequests.
+            The check runs and statuses of each PR's head commit are stored in commit_snapshots,
+            and whether each PR can be merged in pr_mergeable."""
+        owner, name = self.github_project.split("/", 1)
+        variables = {"owner": owner, "name": name, "cursor": None}
+        pulls = []
+        self.pr_mergeable = {}
+        query = self.open_prs_query()
+        while True:
+            run_metrics.count("github_requests")
+            response = GithubConnection.shared_session.post(
+                self.github_graphql_url,
+                json={"query": query, "variables": variables},
+                headers={"Authorization": "bearer {0}".format(self.github_token)},
+                timeout=60,
+            )
+            response.raise_for_status()
+            data = response.json()
+            if data.get("errors"):
+                raise RuntimeError("GraphQL query for open PRs failed: {0}".format(data["errors"]))
+            pull_requests = data["data"]["repository"]["pullRequests"]
+
+            for node in pull_requests["nodes"]:
+                potential_merge_commit = node["potentialMergeCommit"] or {}
+                pulls.append(SimpleNamespace(
+                    number=node["number"],
+                    draft=node["isDraft"],
+                    # PyGithub returns naive datetimes in UTC.
+                    updated_at=datetime.strptime(node["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"),
+                    head=SimpleNamespace(ref=node["headRefName"], sha=node["headRefOid"]),
+                    base=SimpleNamespace(ref=node["baseRefName"], sha=node["baseRefOid"]),
+                    merge_commit_sha=potential_merge_commit.get("oid"),
+                ))
+                self.pr_mergeable[node["number"]] = node["mergeable"]
+
+                commits = node["commits"]["nodes"]
+                if not commits:
+                    continue
+                commit = commits[0]["commit"]
+                check_runs = [
+                    SimpleNamespace(name=run["name"], conclusion=(run["conclusion"] or "").lower() or None)
+                    for suite in commit.get("checkSuites", {}).get("nodes", [])
+                    for check_runs in suite.values()
+                    for run in check_runs["nodes"]
+                ]
+                statuses = [
+                    SimpleNamespace(context=status["context"], state=status["state"].lower(),
+                                    description=status["description"], target_url=status["targetUrl"])
+                    for status in (commit["status"] or {}).get("contexts", [])
+                ]
+                self.commit_snapshots[node["headRefOid"]] = SimpleNamespace(
+                    check_runs=check_runs, statuses=statuses)
+
+            if not pull_requests["pageInfo"]["hasNextPage"]:
+                break
+            variables["cursor"] = pull_requests["pageInfo"]["endCursor"]
+        print("Fetched {0} open PRs with GraphQL".format(len(pulls)))
+        return pulls
+
+    def get_open_prs(self):
+        """ Return the open PRs on GitHub, from the GraphQL API if enabled,
+            falling back to the REST API."""
+        if self.use_graphql:
+            try:
+                return self.get_open_prs_graphql()
+            except (requests.RequestException, RuntimeError, KeyError, TypeError) as e:
+                print("Failed to list open PRs with GraphQL, falling back to REST: {0}".format(e))
+                self.commit_snapshots = {}
+                self.pr_mergeable = {}
         pulls = self.py_gh_repo.get_pulls(state="open")
         print("Rate limit after get_pulls(): {}".format(self.py_github.rate_limiting[0]))
+        return pulls
+
+    def get_check_runs(self, sha):
+        """ Return the check runs for a commit, from the GraphQL snapshot if we have it."""
+        if sha in self.commit_snapshots:
+            return self.commit_snapshots[sha].check_runs
+        return self.get_commit(sha).get_check_runs()
+
+    def get_commit_statuses(self, sha):
+        """ Return the statuses posted to a commit, from the GraphQL snapshot if we have it."""
+        if sha in self.commit_snapshots:
+            return self.commit_snapshots[sha].statuses
+        return self.call_github(self.get_commit(sha).get_combined_status).statuses
+
+    def list_github_prs(self, pulls=None):
+        """ Return two dicts of data about open PRs on GitHub:
+            one for all open PRs, and one for open PRs that are not up-to-date on GitLab.
+            If pulls is given, only those PRs are considered instead of all open PRs."""
+        pr_dict = {}
+        seen_pr_strings = []
+        gitlab_subjects = None
+        main_branch_prs = []
+        merge_commit_prs = []
+        all_pulls = pulls is None
+        if all_pulls:
+            pulls = self.get_open_prs()
         for pull in pulls:
             backlogged = False
             push = True
@@ -133,6 +786,7 @@ class SpackCIBridge(object):
                 push = False
 
             pr_string = "pr{0}_{1}".format(pull.number, pull.head.ref)
+            seen_pr_strings.append(pr_string)
 
             if push and pull.updated_at < datetime.now() + timedelta(minutes=-2880):
                 # Skip further analysis of this PR if it hasn't been updated in 48 hours.
@@ -141,21 +795,24 @@ class SpackCIBridge(object):
                 backlogged = "stale"
                 push = False
 
-            if push:
+            # If an earlier run recorded a decision for this HEAD, we don't need to ask GitLab what it has.
+            recorded = self.state.get_pr(pr_string) if self.state else None
+            if recorded and recorded[0] != pull.head.sha:
+                recorded = None
+            if push and recorded and recorded[2] == "pushed":
+                print("Skip pushing {0} because we already pushed HEAD {1}".format(pr_string, pull.head.sha))
+                push = False
+
+            if push and not recorded:
                 # Determine if this PR still needs to be pushed to GitLab. This happens in one of two cases:
                 # 1) we have never pushed it before
                 # 2) we have pushed it before, but the HEAD sha has changed since we pushed it last
-                log_args = ["git", "log", "--pretty=%s", "gitlab/{0}".format(pr_string)]
-                try:
-                    merge_commit_msg = subprocess.run(
-                        log_args, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
-                    match = self.merge_msg_regex.match(merge_commit_msg.decode("utf-8"))
-                    if match and (match.group(1) == pull.head.sha or match.group(2) == pull.head.sha):
-                        print("Skip pushing {0} because GitLab already has HEAD {1}".format(pr_string, pull.head.sha))
-                        push = False
-                except subprocess.CalledProcessError:
-                    # This occurs when it's a new PR that hasn't been pushed to GitLab yet.
-                    pass
+                if gitlab_subjects is None:
+                    gitlab_subjects = self.get_gitlab_branch_subjects()
+                match = self.merge_msg_regex.match(gitlab_subjects.get(pr_string, ""))
+                if match and (match.group(1) == pull.head.sha or match.group(2) == pull.head.sha):
+                    print("Skip pushing {0} because GitLab already has HEAD {1}".format(pr_string, pull.head.sha))
+                    push = False
 
             if push:
                 # Check the PRs-to-be-pushed to see if any of them should be considered "backlogged".
@@ -166,7 +823,7 @@ class SpackCIBridge(object):
                 if not backlogged and self.prereq_checks:
                     checks_desc = "waiting for {} check to succeed"
                     checks_to_verify = self.prereq_checks.copy()
-                    pr_check_runs = self.get_commit(pull.head.sha).get_check_runs()
+                    pr_check_runs = self.get_check_runs(pull.head.sha)
                     for check in pr_check_runs:
                         if check.name in checks_to_verify:
                             checks_to_verify.remove(check.name)
@@ -181,75 +838,35 @@ class SpackCIBridge(object):
                         print("Skip pushing {0} because of {1}".format(pr_string, backlogged))
 
                 if not backlogged:
-                    if self.main_branch and pull.base.ref == self.main_branch:
-                        # Check if we should defer pushing/testing this PR because it is based on "too new" of a commit
-                        # of the main branch.
-                        tmp_pr_branch = f"temporary_{pr_string}"
-                        subprocess.run(["git", "fetch", "--unshallow", "github",
-                                       f"refs/pull/{pull.number}/head:{tmp_pr_branch}"], check=True)
-                        # Get the merge base between this PR and the main branch.
-                        try:
-                            merge_base_sha = subprocess.run(
-                                ["git", "merge-base", tmp_pr_branch, f"github/{self.main_branch}"],
-                                check=True, stdout=subprocess.PIPE).stdout.strip()
-                        except subprocess.CalledProcessError:
-                            print(f"'git merge-base {tmp_pr_branch} github/{self.main_branch}' "
-                                  "returned non-zero. Skipping")
+                    if recorded and recorded[1] != self.latest_tested_main_commit:
+                        recorded = None
+                    if self.main_branch and pull.base.ref == self.main_branch and recorded:
+                        # An earlier run already checked this HEAD against the latest tested main commit.
+                        if recorded[2] == "unmergeable":
+                            print(f"Skip pushing {pr_string} because it could not be merged with "
+                                  f"{self.latest_tested_main_commit} in an earlier run")
                             self.unmergeable_shas.append(pull.head.sha)
                             continue
-
-                        repo_head_sha = subprocess.run(
-                            ["git", "rev-parse", tmp_pr_branch],
-                            check=True, stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
-
-                        if pull.head.sha != repo_head_sha:
-                            # If gh repo and api don't agree on what the head sha is, don't
-                            # push.  Instead log an error message and backlog the PR.
-                            a_sha, r_sha = pull.head.sha[:7], repo_head_sha[:7]
-                            print(f"Skip pushing {pr_string} because api says HEAD is {a_sha}, "
-                                  f"while repo says HEAD is {r_sha}")
-                            backlogged = f"GitHub HEAD shas out of sync (repo={r_sha}, API={a_sha})"
-                            push = False
-                        # Check if our PR's merge base is an ancestor of the latest tested main branch commit.
-                        elif subprocess.run(
-                                ["git", "merge-base", "--is-ancestor", merge_base_sha, self.latest_tested_main_commit]
-                                ).returncode == 0:
-                            print(f"{tmp_pr_branch}'s merge base IS an ancestor of latest_tested_main "
-                                  f"{merge_base_sha} vs. {self.latest_tested_main_commit}")
-                            try:
-                                subprocess.run(["git", "checkout", self.latest_tested_main_commit], check=True)
-                                subprocess.run(["git", "checkout", "-b", pr_string], check=True)
-                                commit_msg = f"Merge {pull.head.sha} into {self.latest_tested_main_commit}"
-                                subprocess.run(
-                                    ["git", "merge", "--no-ff", "-m", commit_msg, tmp_pr_branch],
-                                    check=True)
-                                print(f"Merge succeeded, ready to push {pr_string} to GitLab for CI pipeline testing")
-                            except subprocess.CalledProcessError:
-                                print(f"Failed to merge PR {pull.number} ({pull.head.ref}) with latest tested "
-                                      f"{self.main_branch} ({self.latest_tested_main_commit}). Skipping")
-                                self.unmergeable_shas.append(pull.head.sha)
-                                subprocess.run(["git", "merge", "--abort"])
-                                backlogged = "merge conflicts with {}".format(self.main_branch)
-                                push = False
-                                continue
-                        else:
-                            print(f"Skip pushing {pr_string} because its merge base is NOT an ancestor of "
-                                  f"latest_tested_main {merge_base_sha} vs. {self.latest_tested_main_commit}")
-                            backlogged = "base"
-                            push = False
+                        print(f"Skip pushing {pr_string} because its merge base is NOT an ancestor of "
+                              f"latest_tested_main {self.latest_tested_main_commit} (found in an earlier run)")
+                        backlogged = "base"
+                        push = False
+                    elif self.main_branch and pull.base.ref == self.main_branch:
+                        # We'll check if we should defer pushing/testing this PR because it is based on "too new"
+                        # of a commit of the main branch, and merge it into the latest tested commit otherwise.
+                        main_branch_prs.append((pr_string, pull))
+                    elif self.pr_mergeable.get(pull.number) == "CONFLICTING":
+                        # GitHub only reports mergeability in the GraphQL listing. A conflicting PR has no
+                        # merge commit for us to push.
+                        print("Skip pushing {0} because it has merge conflicts with {1}".format(
+                            pr_string, pull.base.ref))
+                        backlogged = "merge conflicts with {}".format(pull.base.ref)
+                        push = False
                     else:
                         # If the --main-branch CLI argument wasn't passed, or if this PR doesn't target that branch,
                         # then we will push the merge commit that was automatically created by GitHub to GitLab
                         # where it will kick off a CI pipeline.
-                        try:
-                            subprocess.run(["git", "fetch", "--unshallow", "github",
-                                           f"{pull.merge_commit_sha}:{pr_string}"], check=True)
-                        except subprocess.CalledProcessError:
-                            print("Failed to locally checkout PR {0} ({1}). Skipping"
-                                  .format(pull.number, pull.merge_commit_sha))
-                            backlogged = "GitLab failed to checkout this branch"
-                            push = False
-                            continue
+                        merge_commit_prs.append((pr_string, pull))
 
             pr_dict[pr_string] = {
                 'base_sha': pull.base.sha,
@@ -258,6 +875,9 @@ class SpackCIBridge(object):
                 'backlogged': backlogged,
             }
 
+        # Fetch and merge all the PRs that still need to be pushed at once.
+        self.build_pr_branches(pr_dict, main_branch_prs, merge_commit_prs)
+
         def listify_dict(d):
             pr_strings = sorted(d.keys())
             base_shas = [d[s]['base_sha'] for s in pr_strings]
@@ -279,14 +899,265 @@ class SpackCIBridge(object):
         for pr_string in filtered_open_prs['pr_strings']:
             print("    {0}".format(pr_string))
         print("Rate limit at the end of list_github_prs(): {}".format(self.py_github.rate_limiting[0]))
+        if all_pulls:
+            self.open_pr_strings = seen_pr_strings
+            if self.state:
+                self.state.forget_closed_prs(seen_pr_strings)
         return [all_open_prs, filtered_open_prs]
 
+    def build_pr_branches(self, pr_dict, main_branch_prs, merge_commit_prs):
+        """Create the local branches to push to GitLab for a batch of PRs.
+        PRs that can't be fetched or merged after all are removed from pr_dict,
+        and PRs that turn out to be backlogged are marked as such.
+        """
+        for pr_string, pull in merge_commit_prs:
+            if pull.merge_commit_sha is None:
+                # GitHub hasn't worked out whether this PR can be merged yet, so there is nothing to fetch.
+                print("Skip pushing {0} because GitHub has no merge commit for it".format(pr_string))
+                del pr_dict[pr_string]
+        merge_commit_prs = [(pr_string, pull) for pr_string, pull in merge_commit_prs if pr_string in pr_dict]
+
+        refspecs = {}
+        for pr_string, pull in main_branch_prs:
+            refspecs[pr_string] = f"refs/pull/{pull.number}/head:temporary_{pr_string}"
+        for pr_string, pull in merge_commit_prs:
+            refspecs[pr_string] = f"{pull.merge_commit_sha}:{pr_string}"
+        if not refspecs:
+            return
+
+        with run_metrics.phase("fetch"):
+            failed_refspecs = self.fetch_github_refspecs(list(refspecs.values()))
+        if not self.shallow:
+            # Speeds up the ancestry checks and merges below. Git can't use it in a shallow clone.
+            subprocess.run(["git", "commit-graph", "write", "--reachable", "--split"])
+        for pr_string, pull in main_branch_prs + merge_commit_prs:
+            if refspecs[pr_string] in failed_refspecs:
+                print("Failed to locally checkout PR {0} ({1}). Skipping"
+                      .format(pull.number, refspecs[pr_string].split(":")[0]))
+                del pr_dict[pr_string]
+
+        main_branch_prs = [(pr_string, pull) for pr_string, pull in main_branch_prs if pr_string in pr_dict]
+        if main_branch_prs:
+            with run_metrics.phase("merge"):
+                self.merge_main_branch_prs(pr_dict, main_branch_prs)
+
+    def fetch_github_refspecs(self, refspecs: list[str]) -> set[str]:
+        """Fetch a list of refspecs from GitHub with a single `git fetch`.
+        If that fails, split the refspecs in halves and fetch those, until the ones that can't be fetched
+        are found, and return those. A few bad refspecs only cost a few fetches per bad refspec.
+        """
+        unshallow_args = self.unshallow_args()
+        failed_refspecs = set()
+        batches = [refspecs]
+        while batches:
+            batch = batches.pop()
+            try:
+                subprocess.run(["git", "fetch", "-q", *unshallow_args, "github"] + batch, check=True)
+                # The repository has its full history once a fetch succeeded.
+                unshallow_args = []
+                continue
+            except subprocess.CalledProcessError:
+                pass
+            if len(batch) == 1:
+                failed_refspecs.add(batch[0])
+                continue
+            if batch is refspecs:
+                print("Failed to fetch {0} refs from GitHub at once, splitting them up".format(len(refspecs)))
+            half = len(batch) // 2
+            batches += [batch[half:], batch[:half]]
+        return failed_refspecs
+
+    def merge_main_branch_prs(self, pr_dict, main_branch_prs):
+        """Merge fetched PRs that target the main branch into the latest tested commit of the main branch,
+        unless they are based on a commit of the main branch that GitLab hasn't tested yet.
+        """
+        local_shas = self.get_local_branch_shas()
+        fetched_heads = {}
+        for pr_string, pull in main_branch_prs:
+            tmp_pr_branch = f"temporary_{pr_string}"
+            if local_shas.get(tmp_pr_branch) == pull.head.sha:
+                fetched_heads[tmp_pr_branch] = pull.head.sha
+        untested_branches = self.find_branches_with_untested_main_commits(fetched_heads)
+        if untested_branches is None:
+            # Don't record a verdict that comes from a failed git command, try again in the next run.
+            print(f"Failed to find the {self.main_branch} commits newer than {self.latest_tested_main_commit}. "
+                  f"Skipping {len(main_branch_prs)} PRs")
+            for pr_string, pull in main_branch_prs:
+                del pr_dict[pr_string]
+            return
+
+        mergeable_prs = []
+        for pr_string, pull in main_branch_prs:
+            tmp_pr_branch = f"temporary_{pr_string}"
+            repo_head_sha = local_shas.get(tmp_pr_branch, "")
+            if pull.head.sha != repo_head_sha:
+                # If gh repo and api don't agree on what the head sha is, don't
+                # push.  Instead log an error message and backlog the PR.
+                a_sha, r_sha = pull.head.sha[:7], repo_head_sha[:7]
+                print(f"Skip pushing {pr_string} because api says HEAD is {a_sha}, "
+                      f"while repo says HEAD is {r_sha}")
+                pr_dict[pr_string]["backlogged"] = f"GitHub HEAD shas out of sync (repo={r_sha}, API={a_sha})"
+                pr_dict[pr_string]["push"] = False
+            # Check if our PR's merge base is an ancestor of the latest tested main branch commit.
+            elif tmp_pr_branch in untested_branches:
+                print(f"Skip pushing {pr_string} because its merge base is NOT an ancestor of "
+                      f"latest_tested_main {self.latest_tested_main_commit}")
+                pr_dict[pr_string]["backlogged"] = "base"
+                pr_dict[pr_string]["push"] = False
+                self.record_pr_verdict(pr_string, pull.head.sha, "base")
+            else:
+                print(f"{tmp_pr_branch}'s merge base IS an ancestor of latest_tested_main "
+                      f"{self.latest_tested_main_commit}")
+                mergeable_prs.append((pr_string, pull))
+
+        # Merge without touching the work tree, so that PRs can be merged in parallel.
+        # Then create all of the merge commits at once.
+        def merge_tree(pull):
+            return subprocess.run(
+                ["git", "merge-tree", "--write-tree", "--no-messages", self.latest_tested_main_commit, pull.head.sha],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        with ThreadPoolExecutor(max_workers=self.merge_workers) as executor:
+            merge_results = list(executor.map(merge_tree, [pull for pr_string, pull in mergeable_prs]))
+
+        merges = []
+        for (pr_string, pull), merge_result in zip(mergeable_prs, merge_results):
+            if merge_result.returncode > 1:
+                # Not a conflict but an error, like a missing commit. Try again in the next run.
+                print(f"Failed to run git merge-tree for PR {pull.number} ({pull.head.ref}). Skipping: "
+                      f"{merge_result.stderr.decode('utf-8').strip()}")
+                del pr_dict[pr_string]
+                continue
+            if merge_result.returncode == 1:
+                print(f"Failed to merge PR {pull.number} ({pull.head.ref}) with latest tested "
+                      f"{self.main_branch} ({self.latest_tested_main_commit}). Skipping")
+                self.unmergeable_shas.append(pull.head.sha)
+                self.record_pr_verdict(pr_string, pull.head.sha, "unmergeable")
+                del pr_dict[pr_string]
+                continue
+            tree = merge_result.stdout.decode("utf-8").split("\n")[0]
+            merges.append((pr_string, pull.head.sha, tree))
+
+        if merges:
+            self.write_merge_commits(merges)
+            for pr_string, head_sha, tree in merges:
+                print(f"Merge succeeded, ready to push {pr_string} to GitLab for CI pipeline testing")
+
+    def write_merge_commits(self, merges):
+        """For each (branch, head_sha, tree) in merges, create a branch with a commit that merges head_sha into
+        the latest tested commit of the main branch, whose content is the given tree.
+        All commits are written by a single `git fast-import`.
+        """
+        commands = []
+        for branch, head_sha, tree in merges:
+            commit_msg = f"Merge {head_sha} into {self.latest_tested_main_commit}"
+            commands += [
+                f"commit refs/heads/{branch}",
+                "committer spackbot <noreply@spack.io> now",
+                f"data {len(commit_msg.encode('utf-8'))}",
+                commit_msg,
+                f"from {self.latest_tested_main_commit}",
+                f"merge {head_sha}",
+                f'M 040000 {tree} ""',
+                "",
+            ]
+        subprocess.run(["git", "fast-import", "--quiet", "--force", "--date-format=now"],
+                       input="\n".join(commands).encode("utf-8"), check=True)
+
+    def get_gitlab_branch_subjects(self) -> dict[str, str]:
+        """Return the subject of the latest commit of each branch we fetched from GitLab."""
+        output = subprocess.run(
+            ["git", "for-each-ref", "--format=%(refname:lstrip=3) %(subject)", "refs/remotes/gitlab/"],
+            check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        subjects = {}
+        for line in output.splitlines():
+            branch, _, subject = line.partition(" ")
+            subjects[branch] = subject
+        return subjects
+
+    def get_local_branch_shas(self) -> dict[str, str]:
+        """Return the commit each local branch points to."""
+        output = subprocess.run(
+            ["git", "for-each-ref", "--format=%(refname:lstrip=2) %(objectname)", "refs/heads/"],
+            check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        return dict(line.split(" ", 1) for line in output.splitlines())
+
+    def find_branches_with_untested_main_commits(self, branches: dict[str, str]) -> set[str] | None:
+        """Given a dict of local branch names to the commits they point to, return the branches that contain
+        commits of the main branch that are newer than latest_tested_main_commit. Those are exactly the branches
+        whose merge base with the main branch is not an ancestor of latest_tested_main_commit.
+        Return None if we can't tell.
+        """
+        try:
+            output = subprocess.run(
+                ["git", "rev-list", "--parents", f"github/{self.main_branch}", f"^{self.latest_tested_main_commit}"],
+                check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        except subprocess.CalledProcessError:
+            return None
+        untested = {}
+        for line in output.splitlines():
+            sha, *parents = line.split()
+            untested[sha] = parents
+        # Every untested commit descends from an untested commit whose parents have all been tested,
+        # so it is enough to look for branches that contain one of those.
+        oldest_untested = [sha for sha, parents in untested.items() if not any(p in untested for p in parents)]
+
+        contains = {}
+        hits = 0
+        for ancestor in oldest_untested:
+            unknown = {}
+            for branch, sha in branches.items():
+                cached = self.get_cached_ancestry(ancestor, sha)
+                if cached is None:
+                    unknown[branch] = sha
+                else:
+                    contains[ancestor, sha] = cached
+                    hits += 1
+            if not unknown:
+                continue
+            output = subprocess.run(
+                ["git", "for-each-ref", "--format=%(refname:lstrip=2)", f"--contains={ancestor}",
+                 *(f"refs/heads/{branch}" for branch in unknown)],
+                check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+            found = set(output.split())
+            results = {(ancestor, sha): branch in found for branch, sha in unknown.items()}
+            contains.update(results)
+            self.cache_ancestry(results)
+        if oldest_untested:
+            print("Ancestry cache: {0} hits, {1} misses".format(hits, len(contains) - hits))
+
+        return {branch for branch, sha in branches.items()
+                if any(contains[ancestor, sha] for ancestor in oldest_untested)}
+
+    def get_cached_ancestry(self, ancestor: str, descendant: str) -> bool | None:
+        """Return whether commit ancestor is an ancestor of commit descendant, if we worked that out before."""
+        key = (ancestor, descendant)
+        if key not in self.ancestry_cache and self.state:
+            result = self.state.get_ancestry(ancestor, descendant)
+            if result is not None:
+                self.ancestry_cache[key] = result
+        return self.ancestry_cache.get(key)
+
+    def cache_ancestry(self, results: dict[tuple[str, str], bool]):
+        """Remember whether each (ancestor, descendant) pair of commits is really ancestor and descendant.
+        That never changes, so the answers are also kept in the state file if we have one."""
+        self.ancestry_cache.update(results)
+        if self.state:
+            self.state.set_ancestry(results)
+
+    def record_pr_verdict(self, pr_string, head_sha, verdict):
+        """Remember what we decided for this HEAD of a PR branch, if we have a state file."""
+        if self.state:
+            self.state.set_pr(pr_string, head_sha, self.latest_tested_main_commit, verdict)
+
     def list_github_protected_branches(self) -> list[str]:
         """ Return a list of protected branch names from GitHub."""
         branches = self.py_gh_repo.get_branches()
         print("Rate limit after get_branches(): {}".format(self.py_github.rate_limiting[0]))
         protected_branches = [br.name for br in branches if br.protected]
         protected_branches = sorted(protected_branches)
+        self.github_ref_shas.update(
+            {"refs/heads/{0}".format(br.name): br.commit.sha for br in branches if br.protected})
         if self.currently_running_sha:
             print("Skip pushing {0} because it already has a pipeline running ({1})"
                   .format(self.main_branch, self.currently_running_sha))
@@ -301,6 +1172,7 @@ class SpackCIBridge(object):
         tag_list = self.py_gh_repo.get_tags()
         print("Rate limit after get_tags(): {}".format(self.py_github.rate_limiting[0]))
         tags = sorted([tag.name for tag in tag_list])
+        self.github_ref_shas.update({"refs/tags/{0}".format(tag.name): tag.commit.sha for tag in tag_list})
         print("Tags:")
         for tag in tags:
             print("    {0}".format(tag))
@@ -315,28 +1187,184 @@ class SpackCIBridge(object):
         subprocess.run(["git", "config", "user.email", "noreply@spack.io"], check=True)
         subprocess.run(["git", "config", "user.name", "spackbot"], check=True)
         subprocess.run(["git", "config", "advice.detachedHead", "false"], check=True)
+        subprocess.run(["git", "config", "credential.https://github.com.helper", GITHUB_CREDENTIAL_HELPER], check=True)
         subprocess.run(["git", "remote", "add", "github", self.github_repo], check=True)
         subprocess.run(["git", "remote", "add", "gitlab", self.gitlab_repo], check=True)
 
-        # Shallow fetch from GitLab.
-        self.gitlab_shallow_fetch()
+        if self.shallow:
+            # Shallow fetch from GitLab.
+            self.gitlab_shallow_fetch()
+        else:
+            self.gitlab_fetch()
 
         if self.main_branch:
-            subprocess.run(["git", "fetch", "--unshallow", "github", self.main_branch], check=True)
+            subprocess.run(["git", "fetch", *self.unshallow_args(), "github", self.main_branch], check=True)
 
-    def get_gitlab_pr_branches(self):
-        """Query GitLab for branches that have already been copied over from GitHub PRs.
-        Return the string output of `git branch --remotes --list gitlab/pr*`.
+    def unshallow_args(self) -> list[str]:
+        """Extra arguments for fetching from GitHub, which needs full history to merge and push."""
+        return ["--unshallow"] if self.shallow else []
+
+    def setup_git_mirror(self):
+        """Reuse the repository that earlier runs left in git_mirror, or set it up from scratch.
+        Refs left behind by the last run are deleted, but the objects they point to stay around,
+        so fetching only downloads what changed since then.
         """
-        branch_args = ["git", "branch", "--remotes", "--list", "gitlab/pr*"]
-        self.gitlab_pr_output = \
-            subprocess.run(branch_args, check=True, stdout=subprocess.PIPE).stdout
+        if os.path.isdir(os.path.join(self.git_mirror, ".git")):
+            os.chdir(self.git_mirror)
+            try:
+                # The URLs may have changed since the mirror was set up, and older mirrors had the GitHub
+                # token in the URL of the github remote.
+                subprocess.run(["git", "config", "credential.https://github.com.helper", GITHUB_CREDENTIAL_HELPER],
+                               check=True)
+                subprocess.run(["git", "remote", "set-url", "github", self.github_repo], check=True)
+                subprocess.run(["git", "remote", "set-url", "gitlab", self.gitlab_repo], check=True)
+                self.reset_git_mirror()
+                self.gitlab_fetch()
+                if self.main_branch:
+                    subprocess.run(["git", "fetch", "-q", "github", self.main_branch], check=True)
+                return
+            except subprocess.CalledProcessError:
+                # Tell a network error apart from a broken repository before throwing it away.
+                fsck = subprocess.run(["git", "fsck", "--connectivity-only", "--no-dangling"])
+                if fsck.returncode == 0:
+                    raise
+                print("Git mirror at {0} is corrupted, cloning it again".format(self.git_mirror))
+
+        print("Setting up git mirror at {0}".format(self.git_mirror))
+        shutil.rmtree(self.git_mirror, ignore_errors=True)
+        os.makedirs(self.git_mirror)
+        os.chdir(self.git_mirror)
+        self.setup_git_repo()
+
+    def reset_git_mirror(self):
+        """Throw away the work tree and the local refs that the last run created."""
+        if subprocess.run(["git", "rev-parse", "-q", "--verify", "HEAD"], stdout=subprocess.DEVNULL).returncode == 0:
+            subprocess.run(["git", "reset", "-q", "--hard"], check=True)
+            subprocess.run(["git", "checkout", "-q", "--detach"], check=True)
+            subprocess.run(["git", "clean", "-q", "-fdx"], check=True)
+
+        # Local branches and tags, and protected branches fetched to refs/remotes/<branch>, all get
+        # fetched again in this run if they still exist on GitHub.
+        refs = subprocess.run(
+            ["git", "for-each-ref", "--format=%(refname)", "refs/heads/", "refs/tags/", "refs/remotes/"],
+            check=True, stdout=subprocess.PIPE).stdout.decode("utf-8").split()
+        stale_refs = [ref for ref in refs
+                      if not ref.startswith(("refs/remotes/github/", "refs/remotes/gitlab/"))]
+        commands = "".join("delete {0}\n".format(ref) for ref in stale_refs)
+        subprocess.run(["git", "update-ref", "--stdin"], input=commands.encode("utf-8"), check=True)
+
+    @contextlib.contextmanager
+    def git_repo(self):
+        """Run the body with the current directory set to a git repository ready for syncing:
+        the persistent mirror if we have one, or a temporary clone otherwise."""
+        # Setup SSH command for communicating with GitLab.
+        os.environ["GIT_SSH_COMMAND"] = "ssh -F /dev/null -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
+
+        if self.git_mirror:
+            with run_metrics.phase("git_setup"), self.count_fetched_bytes(self.git_mirror):
+                self.setup_git_mirror()
+            yield
+            subprocess.run(["git", "gc", "--auto", "-q"])
+            return
+
+        # Work inside a temporary directory that will be deleted when this script terminates.
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            os.chdir(tmpdirname)
+
+            # Setup the local repo with two remotes.
+            with run_metrics.phase("git_setup"), self.count_fetched_bytes(tmpdirname):
+                self.setup_git_repo()
+            yield
+
+    def object_store_size(self, path: str = ".") -> int:
+        """Return roughly how many bytes the objects of the repository at path take up."""
+        with run_metrics.uncounted():
+            output = subprocess.run(["git", "-C", path, "count-objects", "-v"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if output.returncode != 0:
+            return 0
+        sizes = dict(line.split(": ", 1) for line in output.stdout.decode("utf-8").splitlines())
+        return (int(sizes.get("size", 0)) + int(sizes.get("size-pack", 0))) * 1024
+
+    @contextlib.contextmanager
+    def count_fetched_bytes(self, path: str = "."):
+        """Count how much the object store of the repository at path grows while running the body
+        as fetched bytes. Git doesn't tell how much it fetched when running quietly."""
+        before = self.object_store_size(path)
+        yield
+        run_metrics.count("bytes_fetched", max(self.object_store_size(path) - before, 0))
+
+    def get_gitlab_pr_branches(self) -> list[str]:
+        """Return the branches we fetched from GitLab that were copied over from GitHub PRs."""
+        branch_args = ["git", "for-each-ref", "--format=%(refname:lstrip=3)", "refs/remotes/gitlab/"]
+        output = subprocess.run(branch_args, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        return [branch for branch in output.split() if self.pr_branch_regex.match(branch)]
+
+    def prune_closed_prs(self):
+        """Delete the GitLab branches of PRs that are no longer open, with one batch of delete refspecs,
+        and their mirrors if we have a bucket for them. Only done after looking at every open PR."""
+        if self.open_pr_strings is None:
+            return
+        open_pr_strings = set(self.open_pr_strings)
+        closed_branches = [branch for branch in self.get_gitlab_pr_branches() if branch not in open_pr_strings]
+        if closed_branches:
+            print("Deleting GitLab branches of {0} closed PRs".format(len(closed_branches)))
+            self.push_refspecs([":{0}".format(branch) for branch in closed_branches])
+        if self.pr_mirror_bucket:
+            self.delete_pr_mirrors(open_pr_strings)
+
+    def delete_pr_mirrors(self, open_pr_strings: set[str], batch_size: int = 1000):
+        """Delete every PR mirror in pr_mirror_bucket that doesn't belong to an open PR.
+        Objects are deleted up to batch_size at a time, the most a DeleteObjects request takes."""
+        s3 = boto3.client("s3", config=Config(retries={"mode": "adaptive"}))
+        paginator = s3.get_paginator("list_objects_v2")
+        # PR branch names can contain slashes, so compare what comes before the first one.
+        open_prefixes = {"{0}/".format(pr_string.split("/")[0]) for pr_string in open_pr_strings}
+        closed_prefixes = [
+            prefix["Prefix"]
+            for page in paginator.paginate(Bucket=self.pr_mirror_bucket, Prefix="pr", Delimiter="/")
+            for prefix in page.get("CommonPrefixes", [])
+            if self.pr_branch_regex.match(prefix["Prefix"]) and prefix["Prefix"] not in open_prefixes
+        ]
+        if not closed_prefixes:
+            return
+
+        print("Deleting mirrors for {0} closed PRs:".format(len(closed_prefixes)))
+        keys: list[str] = []
+        deleted = failed = 0
+
+        def delete_keys():
+            nonlocal deleted, failed
+            response = s3.delete_objects(Bucket=self.pr_mirror_bucket,
+                                         Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+            errors = response.get("Errors", [])
+            for error in errors[:10]:
+                print("    failed to delete {0}: {1}".format(error["Key"], error.get("Message")))
+            deleted += len(keys) - len(errors)
+            failed += len(errors)
+            keys.clear()
+
+        for prefix in closed_prefixes:
+            print("    {0}".format(prefix))
+            for page in paginator.paginate(Bucket=self.pr_mirror_bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    keys.append(obj["Key"])
+                    if len(keys) == batch_size:
+                        delete_keys()
+        if keys:
+            delete_keys()
+        print("Deleted {0} objects from {1}, failed to delete {2}".format(deleted, self.pr_mirror_bucket, failed))
 
     def gitlab_shallow_fetch(self):
         """Perform a shallow fetch from GitLab"""
         fetch_args = ["git", "fetch", "-q", "--depth=1", "gitlab"]
         subprocess.run(fetch_args, check=True, stdout=subprocess.PIPE).stdout
 
+    def gitlab_fetch(self):
+        """Fetch what is new on GitLab, and forget branches that were deleted there"""
+        fetch_args = ["git", "fetch", "-q", "--prune", "gitlab"]
+        subprocess.run(fetch_args, check=True, stdout=subprocess.PIPE)
+
     def get_open_refspecs(self, open_prs: dict[str, list[str]]) -> list[str]:
         """Return a list of refspecs to push given a list of open PRs."""
         print("Building initial lists of refspecs to fetch and push")
@@ -349,6 +1377,34 @@ class SpackCIBridge(object):
             print("  pushing {0} (based on {1})".format(open_pr, base_sha))
         return open_refspecs
 
+    def skip_unchanged_refs(self, protected_branches: list[str], tags: list[str]) -> tuple[list[str], list[str]]:
+        """Return the protected branches and tags that point to a different commit on GitHub than on GitLab.
+        Everything is returned if we can't list the refs on GitLab."""
+        try:
+            output = subprocess.run(["git", "ls-remote", "--heads", "--tags", "gitlab"],
+                                    check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        except subprocess.CalledProcessError:
+            print("Failed to list refs on GitLab, pushing all protected branches and tags")
+            return protected_branches, tags
+
+        gitlab_shas = {}
+        for line in output.splitlines():
+            sha, ref = line.split("\t")
+            if ref.endswith("^{}"):
+                # Annotated tags are followed by the commit they point to, which is what GitHub gave us.
+                gitlab_shas[ref[:-3]] = sha
+            else:
+                gitlab_shas.setdefault(ref, sha)
+
+        def changed(ref):
+            return ref not in self.github_ref_shas or gitlab_shas.get(ref) != self.github_ref_shas[ref]
+
+        changed_branches = [branch for branch in protected_branches if changed("refs/heads/{0}".format(branch))]
+        changed_tags = [tag for tag in tags if changed("refs/tags/{0}".format(tag))]
+        print("Skip pushing {0} protected branches and {1} tags that are up to date on GitLab".format(
+            len(protected_branches) - len(changed_branches), len(tags) - len(changed_tags)))
+        return changed_branches, changed_tags
+
     def update_refspecs_for_protected_branches(
         self,
         protected_branches: list[str],
@@ -375,17 +1431,20 @@ class SpackCIBridge(object):
 
     def fetch_github_branches(self, fetch_refspecs):
         """Perform `git fetch` for a given list of refspecs."""
+        if not fetch_refspecs:
+            return
         print("Fetching GitHub refs for open PRs")
-        fetch_args = ["git", "fetch", "-q", "--unshallow", "github"] + fetch_refspecs
-        subprocess.run(fetch_args, check=True)
+        fetch_args = ["git", "fetch", "-q", *self.unshallow_args(), "github"] + fetch_refspecs
+        with run_metrics.phase("fetch"):
+            subprocess.run(fetch_args, check=True)
 
     def build_local_branches(self, protected_branches):
         """Create local branches for a list of protected branches."""
+        if not protected_branches:
+            return
         print("Building local branches for protected branches")
-        for branch in protected_branches:
-            local_branch_name = "{0}".format(branch)
-            remote_branch_name = "refs/remotes/{0}".format(branch)
-            subprocess.run(["git", "branch", "-q", local_branch_name, remote_branch_name], check=True)
+        commands = "".join("create refs/heads/{0} refs/remotes/{0}\n".format(branch) for branch in protected_branches)
+        subprocess.run(["git", "update-ref", "--stdin"], input=commands.encode("utf-8"), check=True)
 
     def make_status_for_pipeline(self, pipeline):
         """Generate POST data to create a GitHub status from a GitLab pipeline
@@ -447,17 +1506,33 @@ class SpackCIBridge(object):
     def dedupe_pipelines(self, api_response: dict):
         """Prune pipelines API response to only include the most recent result for each SHA"""
         pipelines: dict[str, dict] = {}
+        updated: dict[str, datetime] = {}
         for response in api_response:
             sha: str = response['sha']
             if sha not in pipelines:
                 pipelines[sha] = response
-            else:
-                existing_datetime = dateutil.parser.parse(pipelines[sha]['updated_at'])
-                current_datetime = dateutil.parser.parse(response['updated_at'])
-                if current_datetime > existing_datetime:
-                    pipelines[sha] = response
+                continue
+            # Each timestamp is parsed at most once, and only when there is more than one pipeline for a SHA.
+            if sha not in updated:
+                updated[sha] = parse_timestamp(pipelines[sha]['updated_at'])
+            current_datetime = parse_timestamp(response['updated_at'])
+            if current_datetime > updated[sha]:
+                # Replacing the pipeline in place keeps the SHAs in the order GitLab listed them.
+                pipelines[sha] = response
+                updated[sha] = current_datetime
         return pipelines
 
+    def index_tested_shas(self):
+        """Look up the commits at the tips of GitLab's branches and of the branches we pushed to it,
+        and record which PR HEAD each of them merges, so that we don't have to ask GitLab later."""
+        output = subprocess.run(
+            ["git", "for-each-ref", "--format=%(objectname) %(subject)", "refs/remotes/gitlab/", "refs/heads/"],
+            check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+        for line in output.splitlines():
+            sha, _, subject = line.partition(" ")
+            match = self.merge_msg_regex.match(subject)
+            self.tested_sha_index[sha] = match.group(1) if match else None
+
     def find_pr_sha(self, tested_sha):
         api_url = self.commit_api_template.format(tested_sha)
 
@@ -465,6 +1540,7 @@ class SpackCIBridge(object):
             request = urllib.request.Request(api_url)
             if "GITLAB_TOKEN" in os.environ:
                 request.add_header("Authorization", "Bearer %s" % os.environ["GITLAB_TOKEN"])
+            run_metrics.count("gitlab_requests")
             response = urllib.request.urlopen(request, timeout=10)
         except OSError:
             print('Failed to fetch commit for tested sha {0}'.format(tested_sha))
@@ -491,6 +1567,26 @@ class SpackCIBridge(object):
 
         return m.group(1)
 
+    def gitlab_api_request(self, api_url):
+        """Send a GET request to the GitLab API and return the parsed JSON response,
+        or None if the request failed."""
+        try:
+            request = urllib.request.Request(api_url)
+            if "GITLAB_TOKEN" in os.environ:
+                request.add_header("Authorization", "Bearer %s" % os.environ["GITLAB_TOKEN"])
+            run_metrics.count("gitlab_requests")
+            response = urllib.request.urlopen(request, timeout=10)
+        except OSError as inst:
+            print("GitLab API request error accessing {0}".format(api_url))
+            print(inst)
+            return None
+        try:
+            return json.loads(response.read())
+        except json.decoder.JSONDecodeError as inst:
+            print("Error parsing response to {0}".format(api_url))
+            print(inst)
+            return None
+
     def get_pipelines_for_branch(
         self,
         branch: str,
@@ -505,24 +1601,82 @@ class SpackCIBridge(object):
         if time_threshold:
             api_url = "{0}&updated_after={1}".format(api_url, time_threshold)
 
-        try:
-            request = urllib.request.Request(api_url)
-            if "GITLAB_TOKEN" in os.environ:
-                request.add_header("Authorization", "Bearer %s" % os.environ["GITLAB_TOKEN"])
-            response = urllib.request.urlopen(request, timeout=10)
-        except OSError as inst:
-            print("GitLab API request error accessing {0}".format(api_url))
-            print(inst)
-            return None
-        try:
-            pipelines = json.loads(response.read())
-        except json.decoder.JSONDecodeError as inst:
-            print("Error parsing response to {0}".format(api_url))
-            print(inst)
+        pipelines = self.gitlab_api_request(api_url)
+        if pipelines is None:
             return None
 
         return self.dedupe_pipelines(pipelines)
 
+    def load_recent_pipelines(self, per_page: int = 100):
+        """Fetch every pipeline of the project updated since time_threshold_brief in one paginated
+        sweep, and group them by ref into self.recent_pipelines.
+        If any page fails to load, self.recent_pipelines is left as None."""
+        self.recent_pipelines = None
+        pipelines_by_ref: dict[str, list[dict]] = {}
+        page = 1
+        while True:
+            api_url = "{0}?updated_after={1}&per_page={2}&page={3}".format(
+                self.project_pipelines_api, self.time_threshold_brief, per_page, page)
+            pipelines = self.gitlab_api_request(api_url)
+            if pipelines is None:
+                return
+            for pipeline in pipelines:
+                pipelines_by_ref.setdefault(pipeline["ref"], []).append(pipeline)
+            if len(pipelines) < per_page:
+                break
+            page += 1
+        print("Found recent pipelines for {0} refs in {1} page(s)".format(len(pipelines_by_ref), page))
+        self.recent_pipelines = pipelines_by_ref
+
+    def get_recent_pipelines_for_branch(self, branch: str) -> dict[str, dict] | None:
+        """Return the pipelines updated since time_threshold_brief for a branch, from the sweep done by
+        load_recent_pipelines() if it succeeded or by querying GitLab for this branch otherwise."""
+        if self.recent_pipelines is None:
+            return self.get_pipelines_for_branch(branch, self.time_threshold_brief)
+        return self.dedupe_pipelines(self.recent_pipelines.get(branch, []))
+
+    def post_status_for_branch(self, branch):
+        """Post status to GitHub for each pipeline found for a branch."""
+        pipelines = self.get_recent_pipelines_for_branch(branch)
+        if not pipelines:
+            return
+        for sha, pipeline in pipelines.items():
+            post_data = self.make_status_for_pipeline(pipeline)
+            if not post_data:
+                continue
+            if sha in self.tested_sha_index:
+                # Either a merge commit of a PR, or a commit of a protected branch.
+                pr_sha = self.tested_sha_index[sha] or sha
+            else:
+                pr_sha = self.find_pr_sha(sha)
+            if not pr_sha:
+                print('Could not find github PR sha for tested commit: {0}'.format(sha))
+                print('Using tested commit to post status')
+                pr_sha = sha
+            self.create_status_for_commit(pr_sha,
+                                          branch,
+                                          post_data["state"],
+                                          post_data["target_url"],
+                                          post_data["description"])
+
+    def post_backlogged_status(self, backlog_branch):
+        """Post a pending status explaining why we deferred pushing a branch."""
+        branch, head_sha, reason = backlog_branch
+        if reason == "stale":
+            print("Skip posting status for {} because it has not been updated recently".format(branch))
+            return
+        elif reason == "base":
+            desc = "This branch's merge-base with {} is newer than the latest commit tested by GitLab".format(
+                self.main_branch)
+            url = "https://github.com/spack/spack-infrastructure/blob/main/docs/deferred_pipelines.md"
+        elif reason == "draft":
+            desc = "GitLab CI is disabled for draft PRs"
+            url = ""
+        else:
+            desc = reason
+            url = ""
+        self.create_status_for_commit(head_sha, branch, "pending", url, desc)
+
     def post_pipeline_status(self, open_prs, protected_branches):
         print("Rate limit at the beginning of post_pipeline_status(): {}".format(self.py_github.rate_limiting[0]))
         pipeline_branches = []
@@ -539,70 +1693,48 @@ class SpackCIBridge(object):
                 backlog_branches.append((pr_branch, head_sha, backlog))
 
         pipeline_branches.extend(protected_branches)
+        # GitLab didn't get what we have for branches we failed to push, so its pipelines aren't about them.
+        pipeline_branches = [branch for branch in pipeline_branches
+                             if self.destination_ref(branch) not in self.unpushed_refs]
+
+        if pipeline_branches:
+            self.load_recent_pipelines()
 
         print('Querying pipelines to post status for:')
-        for branch in pipeline_branches:
-            # Post status to GitHub for each pipeline found.
-            pipelines = self.get_pipelines_for_branch(branch, self.time_threshold_brief)
-            if not pipelines:
-                continue
-            for sha, pipeline in pipelines.items():
-                post_data = self.make_status_for_pipeline(pipeline)
-                if not post_data:
-                    continue
-                # TODO: associate shas with protected branches, so we do not have to
-                # hit an endpoint here, but just use the sha we already know just like
-                # we do below for backlogged PR statuses.
-                pr_sha = self.find_pr_sha(sha)
-                if not pr_sha:
-                    print('Could not find github PR sha for tested commit: {0}'.format(sha))
-                    print('Using tested commit to post status')
-                    pr_sha = sha
-                self.create_status_for_commit(pr_sha,
-                                              branch,
-                                              post_data["state"],
-                                              post_data["target_url"],
-                                              post_data["description"])
+        run_grouped(self.post_status_for_branch, pipeline_branches, self.status_workers)
 
         # Post a status of pending/backlogged for branches we deferred pushing
         print("Posting backlogged status to the following:")
-        base_backlog_desc = \
-            "This branch's merge-base with {} is newer than the latest commit tested by GitLab".format(self.main_branch)
-        for branch, head_sha, reason in backlog_branches:
-            if reason == "stale":
-                print("Skip posting status for {} because it has not been updated recently".format(branch))
-                continue
-            elif reason == "base":
-                desc = base_backlog_desc
-                url = "https://github.com/spack/spack-infrastructure/blob/main/docs/deferred_pipelines.md"
-            elif reason == "draft":
-                desc = "GitLab CI is disabled for draft PRs"
-                url = ""
-            else:
-                desc = reason
-                url = ""
-            self.create_status_for_commit(head_sha, branch, "pending", url, desc)
+        run_grouped(self.post_backlogged_status, backlog_branches, self.status_workers)
 
         # Post errors to any PRs that we couldn't merge to latest_tested_main_commit.
         print('Posting unmergeable status to the following:')
-        for sha in self.unmergeable_shas:
+
+        def post_unmergeable_status(sha):
             print('  {0}'.format(sha))
             self.create_status_for_commit(sha, "", "error", "", f"PR could not be merged with {self.main_branch}")
+        run_grouped(post_unmergeable_status, self.unmergeable_shas, self.status_workers)
         print("Rate limit at the end of post_pipeline_status(): {}".format(self.py_github.rate_limiting[0]))
 
     def create_status_for_commit(self, sha, branch, state, target_url, description):
         context = "ci/gitlab-ci"
-        commit = self.get_commit(sha)
-        existing_statuses = commit.get_combined_status()
-        for status in existing_statuses.statuses:
-            if (status.context == context and
-                    status.state == state and
-                    status.description == description and
-                    status.target_url == target_url):
+        last_posted = self.state.get_status(sha, context) if self.state else None
+        if last_posted:
+            # We posted the latest status on this commit ourselves, so there is no need to ask GitHub for it.
+            if last_posted == (state, target_url, description):
                 print("Not posting duplicate status to {} / {}".format(branch, sha))
                 return
+        else:
+            for status in self.get_commit_statuses(sha):
+                if (status.context == context and
+                        status.state == state and
+                        status.description == description and
+                        status.target_url == target_url):
+                    print("Not posting duplicate status to {} / {}".format(branch, sha))
+                    return
         try:
-            status_response = self.get_commit(sha).create_status(
+            status_response = self.call_github(
+                self.get_commit(sha).create_status,
                 state=state,
                 target_url=target_url,
                 description=description,
@@ -611,81 +1743,299 @@ class SpackCIBridge(object):
             if status_response.state != state:
                 print("Expected CommitStatus state {0}, got {1}".format(
                     state, status_response.state))
+            elif self.state:
+                self.state.set_status(sha, context, state, target_url, description)
         except Exception as e_inst:
             print('Caught exception posting status for {0}/{1}'.format(branch, sha))
             print(e_inst)
         print("  {0} -> {1}".format(branch, sha))
 
+    def find_main_branch_pipelines(self):
+        """Find the currently running main branch pipeline, if any, and get the sha.
+        Also get the latest commit on the main branch that has a completed pipeline."""
+        if self.main_branch:
+            main_branch_pipelines = self.get_pipelines_for_branch(self.main_branch)
+
+            if main_branch_pipelines:
+                for sha, pipeline in main_branch_pipelines.items():
+                    if self.latest_tested_main_commit is None and \
+                            (pipeline['status'] == "success" or pipeline['status'] == "failed"):
+                        self.latest_tested_main_commit = sha
+
+                    if self.currently_running_sha is None and pipeline['status'] == "running":
+                        self.currently_running_sha = sha
+
+                    if self.latest_tested_main_commit and self.currently_running_sha:
+                        break
+
+        print("Latest completed {0} pipeline: {1}".format(self.main_branch, self.latest_tested_main_commit))
+        print("Currently running {0} pipeline: {1}".format(self.main_branch, self.currently_running_sha))
+
+    def push_to_gitlab(self, open_refspecs, open_prs=None):
+        """Force-push refspecs to GitLab, and remember that we pushed the HEADs of open_prs."""
+        if not open_refspecs:
+            return
+        print("Syncing to GitLab")
+        with run_metrics.phase("push"):
+            pushed = self.push_refspecs(open_refspecs)
+        self.unpushed_refs.update(
+            self.destination_ref(refspec) for refspec in open_refspecs if refspec not in pushed)
+        if open_prs:
+            for pr_string, head_sha in zip(open_prs["pr_strings"], open_prs["head_shas"]):
+                if "{0}:{0}".format(pr_string) in pushed:
+                    self.record_pr_verdict(pr_string, head_sha, "pushed")
+
+    def raise_for_unpushed_refs(self):
+        """Fail the sync if push_to_gitlab() couldn't push some refs, once everything else has been done."""
+        if self.unpushed_refs:
+            raise Exception("Failed to push {0} refs to GitLab: {1}".format(
+                len(self.unpushed_refs), " ".join(sorted(self.unpushed_refs))))
+
+    def push_refspecs(self, refspecs: list[str], attempts: int = 3) -> set[str]:
+        """Force-push refspecs to GitLab in chunks of push_chunk_size refs, push_workers chunks at a time.
+        Refs that fail to push are retried. Return the refspecs that were pushed."""
+        pushed = set()
+        remaining = list(refspecs)
+        for attempt in range(attempts):
+            if not remaining:
+                break
+            if attempt:
+                print("Retrying {0} refs that failed to push".format(len(remaining)))
+            chunks = [remaining[i:i + self.push_chunk_size] for i in range(0, len(remaining), self.push_chunk_size)]
+            with ThreadPoolExecutor(max_workers=self.push_workers) as executor:
+                results = list(executor.map(self.push_chunk, chunks))
+
+            remaining = []
+            for chunk, (outcomes, seconds, error) in zip(chunks, results):
+                if error:
+                    print(error, end="")
+                for refspec in chunk:
+                    flag, summary = outcomes.get(self.destination_ref(refspec), ("!", "[no result from git push]"))
+                    print("  {0} {1} {2} ({3:.1f}s)".format(flag, refspec, summary, seconds))
+                    if flag == "!":
+                        remaining.append(refspec)
+                    else:
+                        pushed.add(refspec)
+
+        if remaining:
+            print("Failed to push {0} refs to GitLab: {1}".format(len(remaining), " ".join(remaining)))
+        return pushed
+
+    def push_chunk(self, refspecs: list[str]) -> tuple[dict[str, tuple[str, str]], float, str]:
+        """Force-push refspecs to GitLab with one `git push`. Return the flag and summary that git reported
+        for each destination ref, how long the push took, and its error output if it failed."""
+        start = time.monotonic()
+        result = subprocess.run(["git", "push", "--porcelain", "--progress", "-f", "gitlab"] + refspecs,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        seconds = time.monotonic() - start
+
+        # The last progress line about writing objects tells how big the pack we sent was.
+        written = re.findall(r"Writing objects: 100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)",
+                             result.stderr.decode("utf-8", errors="replace"))
+        if written:
+            size, unit = written[-1]
+            run_metrics.count("bytes_pushed", int(float(size) * 1024**("bytes", "KiB", "MiB", "GiB").index(unit)))
+
+        # Lines about refs look like "<flag>\t<from>:<to>\t<summary>".
+        outcomes = {}
+        for line in result.stdout.decode("utf-8").splitlines():
+            fields = line.split("\t")
+            if len(fields) == 3 and ":" in fields[1]:
+                outcomes[fields[1].split(":", 1)[1]] = (fields[0], fields[2])
+        error = result.stderr.decode("utf-8") if result.returncode != 0 else ""
+        return outcomes, seconds, error
+
+    @staticmethod
+    def destination_ref(refspec: str) -> str:
+        """Return the full name of the ref a refspec pushes to."""
+        destination = refspec.split(":")[-1]
+        return destination if destination.startswith("refs/") else "refs/heads/{0}".format(destination)
+
     def sync(self):
         """Synchronize pull requests from GitHub as branches on GitLab."""
 
         print("Initial rate limit: {}".format(self.py_github.rate_limiting[0]))
         reset_time = datetime.utcfromtimestamp(self.py_github.rate_limiting_resettime).strftime('%Y-%m-%d %H:%M:%S')
         print("Rate limit will refresh at: {} UTC".format(reset_time))
+        self.reset_run_state()
+
+        with sentry_sdk.start_transaction(op="sync", name="SpackCIBridge.sync") as transaction:
+            with self.git_repo():
+                with run_metrics.phase("main_pipelines"):
+                    self.find_main_branch_pipelines()
+
+                # Don't update any PRs if no main commits have been tested yet
+                should_update_prs = self.latest_tested_main_commit is not None
+
+                open_refspecs: list[str] = []
+                if should_update_prs:
+                    # Retrieve open PRs from GitHub.
+                    with run_metrics.phase("list_prs"), self.count_fetched_bytes():
+                        all_open_prs, open_prs = self.list_github_prs()
+
+                    # Get refspecs for open PRs and protected branches.
+                    open_refspecs = self.get_open_refspecs(open_prs)
+
+                with run_metrics.phase("list_refs"):
+                    # Get protected branches on GitHub.
+                    protected_branches = self.list_github_protected_branches()
+
+                    # Get tags on GitHub.
+                    tags = self.list_github_tags()
+
+                    # Only fetch and push the ones that changed since we last pushed them.
+                    changed_branches, changed_tags = self.skip_unchanged_refs(protected_branches, tags)
+
+                fetch_refspecs: list[str] = []
+                self.update_refspecs_for_protected_branches(changed_branches, open_refspecs, fetch_refspecs)
+                self.update_refspecs_for_tags(changed_tags, open_refspecs, fetch_refspecs)
+
+                # Sync open GitHub PRs and protected branches to GitLab.
+                with self.count_fetched_bytes():
+                    self.fetch_github_branches(fetch_refspecs)
+                self.build_local_branches(changed_branches)
+                self.push_to_gitlab(open_refspecs, open_prs if should_update_prs else None)
+                with run_metrics.phase("prune"):
+                    self.prune_closed_prs()
+                self.index_tested_shas()
+
+                # Post pipeline status to GitHub for each open PR, if needed
+                if should_update_prs and self.post_status:
+                    print('Posting pipeline status for open PRs and protected branches')
+                    with run_metrics.phase("post_status"):
+                        self.post_pipeline_status(all_open_prs, protected_branches)
+
+            print("GitHub API responses: {0} not modified, {1} fetched".format(
+                GithubConnection.response_cache.hits, GithubConnection.response_cache.misses))
+            summary = run_metrics.summary()
+            # Without SENTRY_DSN the transaction is a no-op span, which can take data but not measurements.
+            for name, value in summary["counters"].items():
+                transaction.set_data(name, value)
+            self.write_run_summary(summary)
+        self.raise_for_unpushed_refs()
+
+    def write_run_summary(self, summary: dict):
+        """Print the timings and counters of a sync, and write them to metrics_file if we have one."""
+        summary["finished_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        summary["github_rate_limit_remaining"] = self.py_github.rate_limiting[0]
+        print("Run summary: {0}".format(json.dumps(summary, sort_keys=True)))
+        if self.metrics_file:
+            with open(self.metrics_file, "w") as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
+    def sync_pr(self, number: int):
+        """Synchronize a single pull request from GitHub to GitLab and post its status."""
+        self.reset_run_state()
+        pull = self.call_github(self.py_gh_repo.get_pull, number)
+        if pull.state != "open":
+            print("Skip syncing PR {0} because it is {1}".format(number, pull.state))
+            return
+
+        with self.git_repo():
+            self.find_main_branch_pipelines()
+            if self.latest_tested_main_commit is None:
+                return
+            all_open_prs, open_prs = self.list_github_prs(pulls=[pull])
+            self.push_to_gitlab(self.get_open_refspecs(open_prs), open_prs)
+            self.index_tested_shas()
+            if self.post_status:
+                self.post_pipeline_status(all_open_prs, [])
+        self.raise_for_unpushed_refs()
+
+    def sync_ref(self, ref: str):
+        """Synchronize a single protected branch or tag from GitHub to GitLab."""
+        self.reset_run_state()
+        open_refspecs: list[str] = []
+        fetch_refspecs: list[str] = []
+        branches = []
+        if ref.startswith("refs/tags/"):
+            self.update_refspecs_for_tags([ref[len("refs/tags/"):]], open_refspecs, fetch_refspecs)
+        elif ref.startswith("refs/heads/"):
+            branch = ref[len("refs/heads/"):]
+            if not self.call_github(self.py_gh_repo.get_branch, branch).protected:
+                return
+            if branch == self.main_branch:
+                self.find_main_branch_pipelines()
+                if self.currently_running_sha:
+                    print("Skip pushing {0} because it already has a pipeline running ({1})"
+                          .format(self.main_branch, self.currently_running_sha))
+                    return
+            branches = [branch]
+            self.update_refspecs_for_protected_branches(branches, open_refspecs, fetch_refspecs)
+        else:
+            return
 
-        # Setup SSH command for communicating with GitLab.
-        os.environ["GIT_SSH_COMMAND"] = "ssh -F /dev/null -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
-
-        # Work inside a temporary directory that will be deleted when this script terminates.
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            os.chdir(tmpdirname)
-
-            # Setup the local repo with two remotes.
-            self.setup_git_repo()
-
-            if self.main_branch:
-                # Find the currently running main branch pipeline, if any, and get the sha.
-                # Also get the latest commit on the main branch that has a completed pipeline.
-                main_branch_pipelines = self.get_pipelines_for_branch(self.main_branch)
-
-                if main_branch_pipelines:
-                    for sha, pipeline in main_branch_pipelines.items():
-                        if self.latest_tested_main_commit is None and \
-                                (pipeline['status'] == "success" or pipeline['status'] == "failed"):
-                            self.latest_tested_main_commit = sha
-
-                        if self.currently_running_sha is None and pipeline['status'] == "running":
-                            self.currently_running_sha = sha
-
-                        if self.latest_tested_main_commit and self.currently_running_sha:
-                            break
-
-            print("Latest completed {0} pipeline: {1}".format(self.main_branch, self.latest_tested_main_commit))
-            print("Currently running {0} pipeline: {1}".format(self.main_branch, self.currently_running_sha))
-
-            # Don't update any PRs if no main commits have been tested yet
-            should_update_prs = self.latest_tested_main_commit is not None
-
-            open_refspecs: list[str] = []
-            if should_update_prs:
-                # Retrieve open PRs from GitHub.
-                all_open_prs, open_prs = self.list_github_prs()
-
-                # Get refspecs for open PRs and protected branches.
-                open_refspecs = self.get_open_refspecs(open_prs)
-
-            # Get protected branches on GitHub.
-            protected_branches = self.list_github_protected_branches()
-
-            # Get tags on GitHub.
-            tags = self.list_github_tags()
-
-            fetch_refspecs: list[str] = []
-            self.update_refspecs_for_protected_branches(protected_branches, open_refspecs, fetch_refspecs)
-            self.update_refspecs_for_tags(tags, open_refspecs, fetch_refspecs)
-
-            # Sync open GitHub PRs and protected branches to GitLab.
+        with self.git_repo():
             self.fetch_github_branches(fetch_refspecs)
-            self.build_local_branches(protected_branches)
-            if open_refspecs:
-                print("Syncing to GitLab")
-                push_args = ["git", "push", "--porcelain", "-f", "gitlab"] + open_refspecs
-                subprocess.run(push_args, check=True)
-
-            # Post pipeline status to GitHub for each open PR, if needed
-            if should_update_prs and self.post_status:
-                print('Posting pipeline status for open PRs and protected branches')
-                self.post_pipeline_status(all_open_prs, protected_branches)
+            self.build_local_branches(branches)
+            self.push_to_gitlab(open_refspecs)
+        self.raise_for_unpushed_refs()
+
+    def webhook_items(self, source: str, event: str, payload: dict) -> list[tuple]:
+        """Return what needs to be synchronized because of a webhook:
+        ("pr", number) for a PR, ("ref", ref) for a protected branch or tag, ("status", ref) to post the
+        status of the pipelines for a branch, or ("sync",) for a full sync."""
+        if source == "github":
+            if event == "pull_request" and payload["action"] in (
+                    "opened", "reopened", "synchronize", "ready_for_review", "converted_to_draft"):
+                return [("pr", payload["pull_request"]["number"])]
+            if event == "check_run" and payload["action"] == "completed" and \
+                    payload["check_run"]["name"] in (self.prereq_checks or ()):
+                # GitHub leaves out PRs from forks here, the periodic full sync picks those up.
+                return [("pr", pr["number"]) for pr in payload["check_run"]["pull_requests"]]
+            if event == "push" and not payload.get("deleted"):
+                return [("ref", payload["ref"])]
+        elif source == "gitlab" and event == "Pipeline Hook":
+            pipeline = payload["object_attributes"]
+            items = [("status", pipeline["ref"])] if self.post_status else []
+            if pipeline["ref"] == self.main_branch and pipeline["status"] in ("success", "failed"):
+                # PRs that were based on a commit that wasn't tested yet may be ready to go now.
+                items.append(("sync",))
+            return items
+        return []
+
+    def sync_webhook_item(self, item: tuple):
+        """Synchronize what a webhook was about."""
+        kind = item[0]
+        if kind == "sync":
+            self.sync()
+        elif kind == "pr":
+            self.sync_pr(item[1])
+        elif kind == "ref":
+            self.sync_ref(item[1])
+        elif kind == "status":
+            self.reset_run_state()
+            self.post_status_for_branch(item[1])
+
+    def process_webhook_queue(self, queue: DebouncedQueue, full_sync_interval: float):
+        """Synchronize what webhooks were about, one at a time, with a full sync every
+        full_sync_interval seconds in case we missed some."""
+        next_full_sync = time.monotonic()
+        while True:
+            timeout = next_full_sync - time.monotonic()
+            item = queue.get(timeout) if timeout > 0 else ("sync",)
+            if item is None:
+                continue
+            if item == ("sync",):
+                # A full sync takes care of everything that was queued so far.
+                queue.clear()
+                next_full_sync = time.monotonic() + full_sync_interval
+            print("Synchronizing {0}".format(item))
+            try:
+                self.sync_webhook_item(item)
+            except Exception as e:
+                print("Failed to synchronize {0}: {1}".format(item, e))
+                sentry_sdk.capture_exception(e)
+
+    def serve_webhooks(self, port: int, full_sync_interval: float, debounce: float):
+        """Listen for webhooks from GitHub and GitLab and synchronize what they are about."""
+        queue = DebouncedQueue(debounce)
+        server = ThreadingHTTPServer(("", port), WebhookHandler)
+        server.bridge = self
+        server.queue = queue
+        threading.Thread(target=self.process_webhook_queue, args=(queue, full_sync_interval), daemon=True).start()
+        print("Listening for webhooks on port {0}".format(port))
+        server.serve_forever()
 
 
 if __name__ == "__main__":
@@ -708,8 +2058,38 @@ to not interrupt this pipeline. We also defer pushing any PR branches that are b
 on a commit of the main branch that is newer than the latest commit tested by GitLab.""")
     parser.add_argument("--prereq-check", nargs="+", default=False,
                         help="Only push branches that have already passed this GitHub check")
+    parser.add_argument("--status-workers", type=int, default=8,
+                        help="Number of branches to query pipelines and post statuses for at once")
+    parser.add_argument("--graphql", action="store_true", default=False,
+                        help="List open PRs along with their checks and statuses using GitHub's GraphQL API")
+    parser.add_argument("--state-file", default=None,
+                        help="SQLite file in which to remember pushed PRs and posted statuses between runs")
+    parser.add_argument("--git-mirror", default=None,
+                        help="Directory in which to keep a full clone between runs, so only new objects get fetched")
+    parser.add_argument("--push-workers", type=int, default=4,
+                        help="Number of git pushes to GitLab to run at once")
+    parser.add_argument("--push-chunk-size", type=int, default=100,
+                        help="Maximum number of refs to push to GitLab with one git push")
+    parser.add_argument("--metrics-file", default=None,
+                        help="File to which to write how long each phase of a sync took, "
+                             "and how many API calls, git commands and bytes it took, as JSON")
+    parser.add_argument("--webhook-port", type=int, default=None,
+                        help="Instead of syncing once, keep running and sync what GitHub and GitLab webhooks "
+                             "sent to this port are about (requires --git-mirror, and GITHUB_WEBHOOK_SECRET and "
+                             "GITLAB_WEBHOOK_TOKEN to verify them with)")
+    parser.add_argument("--full-sync-interval", type=float, default=900,
+                        help="Seconds between full syncs when listening for webhooks")
+    parser.add_argument("--webhook-debounce", type=float, default=10,
+                        help="Seconds to wait for more webhooks about the same PR or branch before syncing it")
+    parser.add_argument("--merge-workers", type=int, default=None,
+                        help="Number of PRs to merge with the latest tested main branch commit at once "
+                             "(default: number of CPUs)")
 
     args = parser.parse_args()
+    if args.webhook_port and not args.git_mirror:
+        parser.error("--webhook-port requires --git-mirror")
+    if args.webhook_port and not (os.getenv("GITHUB_WEBHOOK_SECRET") and os.getenv("GITLAB_WEBHOOK_TOKEN")):
+        parser.error("--webhook-port requires GITHUB_WEBHOOK_SECRET and GITLAB_WEBHOOK_TOKEN to be set")
 
     ssh_key_base64 = os.getenv("GITLAB_SSH_KEY_BASE64")
     if ssh_key_base64 is None:
@@ -725,6 +2105,18 @@ on a commit of the main branch that is newer than the latest commit tested by Gi
                            disable_status_post=args.disable_status_post,
                            sync_draft_prs=args.sync_draft_prs,
                            main_branch=args.main_branch,
-                           prereq_checks=args.prereq_check)
+                           prereq_checks=args.prereq_check,
+                           status_workers=args.status_workers,
+                           use_graphql=args.graphql,
+                           state_file=args.state_file,
+                           git_mirror=args.git_mirror,
+                           merge_workers=args.merge_workers,
+                           push_workers=args.push_workers,
+                           push_chunk_size=args.push_chunk_size,
+                           metrics_file=args.metrics_file,
+                           pr_mirror_bucket=args.pr_mirror_bucket)
     bridge.setup_ssh(ssh_key_base64)
-    bridge.sync()
+    if args.webhook_port:
+        bridge.serve_webhooks(args.webhook_port, args.full_sync_interval, args.webhook_debounce)
+    else:
+        bridge.sync()
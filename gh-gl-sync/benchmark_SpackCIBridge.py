@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""Benchmark how SpackCIBridge scales with the number of open PRs.
+
+For each size this generates a GitHub repository with that many open PRs, plus protected branches and tags,
+in a local bare repository, and serves the GitHub and GitLab APIs for it from a local stub server.
+It then runs a full sync twice: once from scratch, and once more when nothing changed on GitHub.
+For each sync it reports the wall time of each phase, the number of git commands run, and the number of
+GitHub and GitLab API requests made. It also times dedupe_pipelines() on a synthetic pipelines response,
+and compares it with how it used to parse timestamps with dateutil.
+
+    python benchmark_SpackCIBridge.py --sizes 100 1000 5000 --json results.json
+
+Nothing here talks to the network, and the output of the syncs goes to a log file in the work directory.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+from datetime import datetime, timedelta, timezone
+import dateutil.parser
+from github import Github
+from github.Requester import Requester
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import SpackCIBridge
+
+GITHUB_PROJECT = "spack/spack"
+MAIN_BRANCH = "develop"
+RELEASE_BRANCH = "releases/v1"
+MAIN_COMMITS = 50
+TAGS = 20
+
+# The latest commit of the main branch that GitLab tested. PRs based on newer commits get backlogged.
+TESTED_MAIN_COMMIT = MAIN_COMMITS - 5
+
+
+class StubConnection(SpackCIBridge.GithubConnection):
+    """The stub server speaks plain HTTP."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.protocol = "http"
+
+
+Requester.injectConnectionClasses(StubConnection, StubConnection)
+
+
+class SyntheticProject(object):
+    """A GitHub repository with open PRs, and the GitLab repository the bridge pushes them to.
+    Every tenth PR targets the release branch, and gets a merge commit like GitHub makes for it.
+    The other PRs target the main branch, based on one of its commits.
+    """
+
+    def __init__(self, workdir: str, num_prs: int):
+        self.workdir = workdir
+        self.num_prs = num_prs
+        self.github_repo = os.path.join(workdir, "github.git")
+        self.gitlab_repo = os.path.join(workdir, "gitlab.git")
+        self.updated_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.shas: dict[int, str] = {}
+        self.pulls: list[dict] = []
+        self.branches: list[dict] = []
+        self.tags: list[dict] = []
+
+    def mark(self, kind: str, i: int = 0) -> int:
+        """Return the fast-import mark of the main branch commit, release branch commit,
+        PR head or PR merge commit number i."""
+        offsets = {"main": 0, "release": MAIN_COMMITS + 1, "head": MAIN_COMMITS + 2,
+                   "merge": MAIN_COMMITS + 2 + self.num_prs}
+        return offsets[kind] + i
+
+    def create(self):
+        for repo in (self.github_repo, self.gitlab_repo):
+            subprocess.run(["git", "init", "-q", "--bare", repo], check=True)
+
+        marks_file = os.path.join(self.workdir, "marks")
+        subprocess.run(["git", "-C", self.github_repo, "fast-import", "--quiet",
+                        "--export-marks={0}".format(marks_file)],
+                       input=self.fast_import_stream().encode("utf-8"), check=True)
+        with open(marks_file) as f:
+            for line in f:
+                mark, sha = line.split()
+                self.shas[int(mark[1:])] = sha
+
+        # GitLab has already tested part of the main branch.
+        subprocess.run(["git", "-C", self.github_repo, "push", "-q", self.gitlab_repo,
+                        "{0}:refs/heads/{1}".format(self.shas[self.mark("main", TESTED_MAIN_COMMIT)], MAIN_BRANCH)],
+                       check=True)
+
+        base_shas = {MAIN_BRANCH: self.shas[self.mark("main", MAIN_COMMITS)],
+                     RELEASE_BRANCH: self.shas[self.mark("release")]}
+        for i in range(1, self.num_prs + 1):
+            base = RELEASE_BRANCH if i % 10 == 0 else MAIN_BRANCH
+            self.pulls.append({
+                "number": i,
+                "state": "open",
+                "draft": i % 50 == 7,
+                "updated_at": self.updated_at,
+                "head": {"ref": "feature-{0}".format(i), "sha": self.shas[self.mark("head", i)]},
+                "base": {"ref": base, "sha": base_shas[base]},
+                "merge_commit_sha": self.shas.get(self.mark("merge", i)),
+            })
+        self.branches = [{"name": name, "protected": True, "commit": {"sha": sha}}
+                         for name, sha in sorted(base_shas.items())]
+        self.tags = [{"name": "v0.{0}".format(t), "commit": {"sha": self.shas[self.mark("main", t * 2)]}}
+                     for t in range(1, TAGS + 1)]
+
+    def fast_import_stream(self) -> str:
+        commands = []
+
+        def commit(ref, mark, parents, path):
+            message = "{0} {1}".format(ref, mark)
+            commands.append("commit {0}\nmark :{1}\ncommitter Bench <bench@spack.io> 1700000000 +0000\n"
+                            "data {2}\n{3}\n".format(ref, mark, len(message), message))
+            for n, parent in enumerate(parents):
+                commands.append("{0} :{1}\n".format("from" if n == 0 else "merge", parent))
+            commands.append("M 644 inline {0}\ndata {1}\n{2}\n".format(path, len(message), message))
+
+        for i in range(1, MAIN_COMMITS + 1):
+            commit("refs/heads/{0}".format(MAIN_BRANCH), self.mark("main", i),
+                   [self.mark("main", i - 1)] if i > 1 else [], "main.txt")
+        commit("refs/heads/{0}".format(RELEASE_BRANCH), self.mark("release"), [self.mark("main", 10)], "release.txt")
+        for i in range(1, self.num_prs + 1):
+            if i % 10 == 0:
+                commit("refs/pull/{0}/head".format(i), self.mark("head", i), [self.mark("release")],
+                       "prs/{0}.txt".format(i))
+                commit("refs/pull/{0}/merge".format(i), self.mark("merge", i),
+                       [self.mark("release"), self.mark("head", i)], "prs/{0}.txt".format(i))
+            else:
+                commit("refs/pull/{0}/head".format(i), self.mark("head", i),
+                       [self.mark("main", 1 + i % MAIN_COMMITS)], "prs/{0}.txt".format(i))
+        for t in range(1, TAGS + 1):
+            commands.append("reset refs/tags/v0.{0}\nfrom :{1}\n\n".format(t, self.mark("main", t * 2)))
+        return "".join(commands)
+
+    def gitlab_branches(self) -> dict[str, str]:
+        """Return the commit of each branch on GitLab. This reads the ref files directly,
+        so the stub server doesn't add to the git commands the bridge runs."""
+        branches = {}
+        packed_refs = os.path.join(self.gitlab_repo, "packed-refs")
+        if os.path.exists(packed_refs):
+            with open(packed_refs) as f:
+                for line in f:
+                    sha, _, ref = line.strip().partition(" ")
+                    if ref.startswith("refs/heads/"):
+                        branches[ref[len("refs/heads/"):]] = sha
+        heads = os.path.join(self.gitlab_repo, "refs", "heads")
+        for root, dirs, files in os.walk(heads):
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path) as f:
+                    branches[os.path.relpath(path, heads)] = f.read().strip()
+        return branches
+
+    def pipelines(self, ref: str | None = None) -> list[dict]:
+        """Return two pipelines for the commit at the tip of each GitLab branch: one that was canceled,
+        and a newer one that succeeded. The main branch pipeline tested TESTED_MAIN_COMMIT."""
+        now = datetime.now(timezone.utc)
+        pipelines = []
+        for branch, sha in sorted(self.gitlab_branches().items()):
+            if ref and branch != ref:
+                continue
+            for status, age in (("canceled", 20), ("success", 10)):
+                pipeline_id = 2 * int(sha[:8], 16) + (status == "success")
+                pipelines.append({
+                    "id": pipeline_id,
+                    "sha": sha,
+                    "ref": branch,
+                    "status": status,
+                    "updated_at": (now - timedelta(minutes=age)).isoformat(timespec="milliseconds")[:-6] + "Z",
+                    "web_url": "https://gitlab.spack.io/spack/spack/-/pipelines/{0}".format(pipeline_id),
+                })
+        # Newest first, like GitLab.
+        return pipelines[::-1]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves what the bridge asks from the GitHub API under /, and the GitLab API under /api/v4/."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, verb: str):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        project = self.server.project
+        is_gitlab = url.path.startswith("/api/v4/")
+        self.server.count("gitlab" if is_gitlab else "github")
+
+        repo_path = "/repos/{0}".format(GITHUB_PROJECT)
+        gitlab_path = "/api/v4/projects/{0}".format(urllib.parse.quote_plus(GITHUB_PROJECT))
+        if url.path == "/rate_limit":
+            limit = {"limit": 5000, "remaining": 5000, "reset": int(time.time()) + 3600}
+            return self.respond(200, {"resources": {"core": limit, "search": limit, "graphql": limit}, "rate": limit})
+        if url.path == repo_path + "/pulls":
+            return self.respond_paginated(url, query, project.pulls)
+        if url.path == repo_path + "/branches":
+            return self.respond_paginated(url, query, project.branches)
+        if url.path == repo_path + "/tags":
+            return self.respond_paginated(url, query, project.tags)
+        if url.path.startswith(repo_path + "/commits/"):
+            sha, _, rest = url.path[len(repo_path + "/commits/"):].partition("/")
+            if rest == "status":
+                statuses = self.server.statuses.get(sha, [])
+                return self.respond(200, {"sha": sha, "state": "pending", "total_count": len(statuses),
+                                          "statuses": statuses})
+            return self.respond(200, {"sha": sha, "url": self.server.url + repo_path + "/commits/" + sha})
+        if url.path.startswith(repo_path + "/statuses/") and verb == "POST":
+            sha = url.path.rsplit("/", 1)[1]
+            status = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with self.server.lock:
+                self.server.statuses.setdefault(sha, []).insert(0, status)
+            return self.respond(201, status)
+        if url.path == gitlab_path + "/pipelines":
+            return self.respond_paginated(url, query, project.pipelines(query.get("ref")), link=False)
+        if url.path.startswith(gitlab_path + "/repository/commits/"):
+            return self.respond(404, {"message": "404 Commit Not Found"})
+        self.respond(404, {"message": "Not Found"})
+
+    def respond_paginated(self, url, query: dict, items: list, link: bool = True):
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 30 if link else 20))
+        headers = {}
+        if link and page * per_page < len(items):
+            next_query = dict(query, page=str(page + 1))
+            headers["Link"] = '<{0}{1}?{2}>; rel="next"'.format(
+                self.server.url, url.path, urllib.parse.urlencode(next_query))
+        self.respond(200, items[(page - 1) * per_page:page * per_page], headers)
+
+    def respond(self, code: int, data, headers: dict = {}):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "5000")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, project: SyntheticProject):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.project = project
+        self.url = "http://127.0.0.1:{0}".format(self.server_address[1])
+        self.lock = threading.Lock()
+        self.statuses: dict[str, list[dict]] = {}
+        self.requests = {"github": 0, "gitlab": 0}
+
+    def count(self, api: str):
+        with self.lock:
+            self.requests[api] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = dict.fromkeys(self.requests, 0)
+
+
+@contextlib.contextmanager
+def output_to(log_path: str):
+    """Send everything the bridge and the git commands it runs print to a log file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(log_path, "a") as log:
+        saved = [os.dup(1), os.dup(2)]
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            with contextlib.redirect_stdout(log):
+                yield
+        finally:
+            log.flush()
+            for fd, saved_fd in enumerate(saved, 1):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+
+def benchmark_sync(workdir: str, num_prs: int) -> list[dict]:
+    """Sync a synthetic project with num_prs open PRs from scratch, and then once more."""
+    project = SyntheticProject(workdir, num_prs)
+    project.create()
+    server = StubServer(project)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    bridge = SpackCIBridge.SpackCIBridge(
+        gitlab_repo="file://" + project.gitlab_repo,
+        gitlab_host=server.url,
+        gitlab_project=GITHUB_PROJECT,
+        github_project=GITHUB_PROJECT,
+        disable_status_post=False,
+        main_branch=MAIN_BRANCH,
+        state_file=os.path.join(workdir, "state.db"),
+        git_mirror=os.path.join(workdir, "mirror"),
+    )
+    bridge.github_repo = "file://" + project.github_repo
+    bridge.py_github = Github(base_url=server.url)
+    bridge.py_gh_repo = bridge.py_github.get_repo(GITHUB_PROJECT, lazy=True)
+
+    results = []
+    try:
+        for run in ("cold", "warm"):
+            server.reset_counts()
+            start = time.monotonic()
+            with output_to(os.path.join(workdir, "sync.log")):
+                bridge.sync()
+            summary = SpackCIBridge.run_metrics.summary()
+            results.append({
+                "benchmark": "sync",
+                "run": run,
+                "prs": num_prs,
+                "seconds": round(time.monotonic() - start, 3),
+                "phases": summary["phases"],
+                "git_commands": summary["counters"]["git_commands"],
+                "github_requests": server.requests["github"],
+                "gitlab_requests": server.requests["gitlab"],
+            })
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def synthetic_pipelines(num_shas: int, per_sha: int = 3) -> list[dict]:
+    """Return a pipelines API response with per_sha pipelines for each of num_shas commits, in random order."""
+    now = datetime.now(timezone.utc)
+    pipelines = [
+        {"sha": "{0:040x}".format(sha), "status": "success",
+         "updated_at": (now - timedelta(seconds=random.randrange(86400))).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"}
+        for sha in range(num_shas)
+        for _ in range(per_sha)
+    ]
+    random.shuffle(pipelines)
+    return pipelines
+
+
+def dedupe_pipelines_with_dateutil(api_response: list[dict]) -> dict[str, dict]:
+    """dedupe_pipelines() as it was when it parsed timestamps with dateutil, to compare against."""
+    pipelines: dict[str, dict] = {}
+    for response in api_response:
+        sha: str = response['sha']
+        if sha not in pipelines:
+            pipelines[sha] = response
+        else:
+            existing_datetime = dateutil.parser.parse(pipelines[sha]['updated_at'])
+            current_datetime = dateutil.parser.parse(response['updated_at'])
+            if current_datetime > existing_datetime:
+                pipelines[sha] = response
+    return pipelines
+
+
+def benchmark_dedupe_pipelines(num_prs: int, repeat: int = 5) -> dict:
+    bridge = SpackCIBridge.SpackCIBridge()
+    pipelines = synthetic_pipelines(num_prs)
+    deduped = bridge.dedupe_pipelines(pipelines)
+    assert list(deduped.items()) == list(dedupe_pipelines_with_dateutil(pipelines).items())
+    return {
+        "benchmark": "dedupe_pipelines",
+        "prs": num_prs,
+        "pipelines": len(pipelines),
+        "seconds": min(timed(bridge.dedupe_pipelines, pipelines) for _ in range(repeat)),
+        "dateutil_seconds": min(timed(dedupe_pipelines_with_dateutil, pipelines) for _ in range(repeat)),
+    }
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return round(time.perf_counter() - start, 4)
+
+
+def print_results(results: list[dict]):
+    for result in results:
+        if result["benchmark"] == "sync":
+            phases = " ".join("{0}={1:.2f}s".format(name, seconds) for name, seconds in result["phases"].items())
+            print("sync {0:>5} PRs {1:<4} {2:7.2f}s  git={3:<5} github={4:<6} gitlab={5:<5} {6}".format(
+                result["prs"], result["run"], result["seconds"], result["git_commands"],
+                result["github_requests"], result["gitlab_requests"], phases))
+        else:
+            print("{0} {1:>5} PRs ({2} pipelines) {3:.4f}s (with dateutil: {4:.4f}s)".format(
+                result["benchmark"], result["prs"], result["pipelines"], result["seconds"],
+                result["dateutil_seconds"]))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SpackCIBridge with synthetic PRs and pipelines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000],
+                        help="Numbers of open PRs to benchmark with")
+    parser.add_argument("--json", default=None, help="Write the results to this file as JSON")
+    parser.add_argument("--workdir", default=None,
+                        help="Directory in which to create the repositories and logs, which are kept "
+                             "(default: a temporary directory that gets deleted)")
+    args = parser.parse_args()
+
+    os.environ.pop("GITLAB_TOKEN", None)
+    os.environ.setdefault("GITHUB_TOKEN", "benchmark")
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bridge-benchmark-")
+    cwd = os.getcwd()
+    results = []
+    try:
+        for size in args.sizes:
+            size_workdir = os.path.join(workdir, str(size))
+            shutil.rmtree(size_workdir, ignore_errors=True)
+            os.makedirs(size_workdir)
+            size_results = benchmark_sync(size_workdir, size) + [benchmark_dedupe_pipelines(size)]
+            os.chdir(cwd)
+            print_results(size_results)
+            results.extend(size_results)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
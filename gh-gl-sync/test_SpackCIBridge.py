@@ -1,6 +1,7 @@
+import json
 import os
 from datetime import datetime
-from unittest.mock import create_autospec, patch, Mock
+from unittest.mock import patch, Mock
 
 import SpackCIBridge
 
@@ -68,44 +69,37 @@ def test_list_github_prs(capfd):
     bridge.py_gh_repo = gh_repo
     bridge.py_github = py_github
     bridge.main_branch = "main"
+    bridge.latest_tested_main_commit = "shamain"
 
-    import subprocess
-    actual_run_method = subprocess.run
-
-    subprocess.run = create_autospec(subprocess.run)
-    subprocess.run.side_effect = [
-        # 1st PR
-        AttrDict({"stdout": b"Merge bbbbbbb into ccccccc"}),  # git log --pretty
-        AttrDict({"stdout":  b""}),                           # git fetch
-        AttrDict({"stdout":  b"shabar", "returncode": 0}),    # git merge-base
-        AttrDict({"stdout":  b"shafoo"}),                     # git rev-parse
-        AttrDict({"returncode": 0}),                          # git merge-base --is-ancestor
-        AttrDict({"stdout":  b""}),                           # git checkout latest_tested
-        AttrDict({"stdout":  b""}),                           # git checkout -b pr_string
-        AttrDict({"stdout":  b""}),                           # git merge
-        # 2nd PR
-        AttrDict({"stdout": b"Merge shagah into ccccccc"}),
-        AttrDict({"stdout":  b""}),
-        AttrDict({"stdout":  b"shafaz", "returndcode": 0}),
-        AttrDict({"stdout":  b"shagah"}),
-        AttrDict({"returncode":  0}),
-        AttrDict({"stdout":  b""}),
-        AttrDict({"stdout":  b""}),
-        AttrDict({"stdout":  b""}),
+    run_results = [
+        # Tips of the PR branches on GitLab (git for-each-ref)
+        AttrDict({"stdout": b"pr1_improve_docs Merge bbbbbbb into ccccccc\npr2_fix_test Merge shagah into ccccccc\n"}),
+        AttrDict({"stdout": b""}),                                          # git fetch
+        AttrDict({"stdout": b"temporary_pr1_improve_docs shafoo\n"}),      # git for-each-ref
+        AttrDict({"stdout": b""}),                                          # git rev-list
+        AttrDict({"stdout": b"shatree\n", "returncode": 0}),               # git merge-tree
+        AttrDict({"stdout": b""}),                                          # git fast-import
     ]
 
-    retval = bridge.list_github_prs()
-    subprocess.run = actual_run_method
+    with patch("subprocess.run", side_effect=run_results) as mock_run:
+        retval = bridge.list_github_prs()
+    fetch_args = mock_run.call_args_list[1].args[0]
+    fast_import_input = mock_run.call_args_list[5].kwargs["input"].decode("utf-8")
+
+    assert fetch_args == ["git", "fetch", "-q", "--unshallow", "github",
+                          "refs/pull/1/head:temporary_pr1_improve_docs"]
+    assert "commit refs/heads/pr1_improve_docs\n" in fast_import_input
+    assert "from shamain\nmerge shafoo\nM 040000 shatree" in fast_import_input
 
     github_prs = retval[0]
     assert github_prs["pr_strings"] == ["pr1_improve_docs", "pr2_fix_test", "pr3_wip"]
     assert gh_repo.get_pulls.call_count == 1
     out, err = capfd.readouterr()
     expected = """Rate limit after get_pulls(): 5000
-temporary_pr1_improve_docs's merge base IS an ancestor of latest_tested_main b'shabar' vs. None
-Merge succeeded, ready to push pr1_improve_docs to GitLab for CI pipeline testing
 Skip pushing pr2_fix_test because GitLab already has HEAD shagah
 Skipping draft PR 3 (wip)
+temporary_pr1_improve_docs's merge base IS an ancestor of latest_tested_main shamain
+Merge succeeded, ready to push pr1_improve_docs to GitLab for CI pipeline testing
 All Open PRs:
     pr1_improve_docs
     pr2_fix_test
@@ -123,27 +117,33 @@ def test_list_github_protected_branches(capfd):
     github_branches_response = [
         AttrDict({
             "name": "alpha",
-            "protected": True
+            "protected": True,
+            "commit": {"sha": "shaalpha"}
         }),
         AttrDict({
           "name": "develop",
-          "protected": True
+          "protected": True,
+          "commit": {"sha": "shadevelop"}
         }),
         AttrDict({
           "name": "feature",
-          "protected": False
+          "protected": False,
+          "commit": {"sha": "shafeature"}
         }),
         AttrDict({
           "name": "main",
-          "protected": True
+          "protected": True,
+          "commit": {"sha": "shamain"}
         }),
         AttrDict({
           "name": "release",
-          "protected": True
+          "protected": True,
+          "commit": {"sha": "sharelease"}
         }),
         AttrDict({
           "name": "wip",
-          "protected": False
+          "protected": False,
+          "commit": {"sha": "shawip"}
         }),
     ]
     gh_repo = Mock()
@@ -291,6 +291,20 @@ def test_dedupe_pipelines():
     assert bridge.dedupe_pipelines(input) == expected
 
 
+def test_dedupe_pipelines_keeps_order():
+    """Test that dedupe_pipelines keeps SHAs in the order GitLab listed them, whatever the timestamp format."""
+    input = [
+        {"id": 4, "sha": "shaa", "updated_at": "2020-08-27T17:27:36.807Z"},
+        {"id": 3, "sha": "shab", "updated_at": "2020-08-27T19:27:36.807+02:00"},
+        {"id": 2, "sha": "shab", "updated_at": "2020-08-27T17:27:37Z"},
+        {"id": 1, "sha": "shaa", "updated_at": "Aug 26 2020 17:26:36 UTC"},
+    ]
+    bridge = SpackCIBridge.SpackCIBridge()
+    pipelines = bridge.dedupe_pipelines(input)
+    assert list(pipelines) == ["shaa", "shab"]
+    assert [pipeline["id"] for pipeline in pipelines.values()] == [4, 2]
+
+
 def test_make_status_for_pipeline():
     """Test the make_status_for_pipeline method."""
     bridge = SpackCIBridge.SpackCIBridge()
@@ -456,14 +470,11 @@ def test_pipeline_status_backlogged_by_checks(capfd):
         bridge.py_gh_repo = gh_repo
         bridge.currently_running_sha = None
 
-        import subprocess
-        actual_run_method = subprocess.run
         mock_run_return = Mock()
         mock_run_return.stdout = b"Merge shagah into ccccccc"
 
-        subprocess.run = create_autospec(subprocess.run, return_value=mock_run_return)
-        all_open_prs, open_prs = bridge.list_github_prs()
-        subprocess.run = actual_run_method
+        with patch("subprocess.run", return_value=mock_run_return):
+            all_open_prs, open_prs = bridge.list_github_prs()
 
         os.environ["GITHUB_TOKEN"] = "my_github_token"
 
@@ -537,3 +548,704 @@ def test_pipeline_status_backlogged_for_draft_PR(capfd):
   pr1_readme -> shabaz"""
     assert expected_content in out
     del os.environ["GITHUB_TOKEN"]
+
+
+def test_post_pipeline_status_groups_output_per_branch(capfd):
+    """Test that statuses posted concurrently still get logged in order, one branch at a time."""
+    open_prs = {
+        "pr_strings": ["pr1_readme", "pr2_todo", "pr3_docs"],
+        "base_shas": ["shafoo", "shabar", "shabaz"],
+        "head_shas": ["shaaaa", "shabbb", "shaccc"],
+        "backlogged": [False, False, False]
+    }
+
+    gh_commit = Mock()
+    gh_commit.create_status.return_value = AttrDict({"state": "error"})
+    gh_commit.get_combined_status.return_value = AttrDict({'statuses': []})
+    gh_repo = Mock()
+    gh_repo.get_commit.return_value = gh_commit
+
+    bridge = SpackCIBridge.SpackCIBridge(gitlab_host="https://gitlab.spack.io",
+                                         gitlab_project="zack/my_test_proj",
+                                         github_project="zack/my_test_proj",
+                                         status_workers=3)
+    bridge.py_github = py_github
+    bridge.py_gh_repo = gh_repo
+    bridge.find_pr_sha = Mock(return_value=None)
+
+    def load_recent_pipelines():
+        bridge.recent_pipelines = {
+            branch: [{"id": 1, "sha": branch[-1] * 40, "ref": branch, "status": "failed", "web_url": "foo"}]
+            for branch in open_prs["pr_strings"]
+        }
+    bridge.load_recent_pipelines = load_recent_pipelines
+
+    bridge.post_pipeline_status(open_prs, [])
+    assert gh_commit.create_status.call_count == 3
+    out, err = capfd.readouterr()
+    expected = """Querying pipelines to post status for:
+Could not find github PR sha for tested commit: {0}
+Using tested commit to post status
+  pr1_readme -> {0}
+Could not find github PR sha for tested commit: {1}
+Using tested commit to post status
+  pr2_todo -> {1}
+Could not find github PR sha for tested commit: {2}
+Using tested commit to post status
+  pr3_docs -> {2}
+""".format("e" * 40, "o" * 40, "s" * 40)
+    assert expected in out
+
+
+def test_call_github_secondary_rate_limit(capfd):
+    """Test that call_github retries requests that hit GitHub's secondary rate limit."""
+    bridge = SpackCIBridge.SpackCIBridge()
+    rate_limited = SpackCIBridge.GithubException(
+        403, {"message": "You have exceeded a secondary rate limit."}, {"retry-after": "0"})
+    github_method = Mock(side_effect=[rate_limited, "ok"])
+    assert bridge.call_github(github_method, state="pending") == "ok"
+    assert github_method.call_count == 2
+    out, err = capfd.readouterr()
+    assert "Hit GitHub's secondary rate limit, waiting 0 seconds" in out
+
+    # Other errors are not retried.
+    forbidden = SpackCIBridge.GithubException(403, {"message": "Resource not accessible"}, {})
+    github_method = Mock(side_effect=forbidden)
+    try:
+        bridge.call_github(github_method)
+        assert False
+    except SpackCIBridge.GithubException:
+        pass
+    assert github_method.call_count == 1
+
+
+def test_load_recent_pipelines():
+    """Test that load_recent_pipelines pages through all recent pipelines and groups them by ref."""
+    bridge = SpackCIBridge.SpackCIBridge(gitlab_host="https://gitlab.spack.io",
+                                         gitlab_project="zack/my_test_proj")
+    bridge.time_threshold_brief = "2020-08-26T16%3A00%3A00%2B00%3A00"
+    pages = [
+        [
+            {"id": 4, "sha": "bbbb", "ref": "pr2_todo", "updated_at": "2020-08-26T17:30:00.000Z"},
+            {"id": 3, "sha": "aaaa", "ref": "pr1_readme", "updated_at": "2020-08-26T17:28:00.000Z"},
+        ],
+        [
+            {"id": 2, "sha": "aaaa", "ref": "pr1_readme", "updated_at": "2020-08-26T17:27:00.000Z"},
+        ],
+    ]
+    with patch('urllib.request.urlopen',
+               side_effect=[FakeResponse(data=json.dumps(page).encode()) for page in pages]) as mock_urlopen:
+        bridge.load_recent_pipelines(per_page=2)
+        assert mock_urlopen.call_count == 2
+        urls = [call.args[0].full_url for call in mock_urlopen.call_args_list]
+    assert urls == [
+        "https://gitlab.spack.io/api/v4/projects/zack%2Fmy_test_proj/pipelines"
+        "?updated_after=2020-08-26T16%3A00%3A00%2B00%3A00&per_page=2&page=1",
+        "https://gitlab.spack.io/api/v4/projects/zack%2Fmy_test_proj/pipelines"
+        "?updated_after=2020-08-26T16%3A00%3A00%2B00%3A00&per_page=2&page=2",
+    ]
+    assert [p["id"] for p in bridge.recent_pipelines["pr1_readme"]] == [3, 2]
+    assert bridge.get_recent_pipelines_for_branch("pr1_readme") == {"aaaa": pages[0][1]}
+    assert bridge.get_recent_pipelines_for_branch("pr3_gone") == {}
+
+
+def test_get_open_prs_graphql():
+    """Test that open PRs and their head commit checks come from one GraphQL query."""
+    node = {
+        "number": 1,
+        "isDraft": False,
+        "updatedAt": "2020-08-26T17:30:00Z",
+        "mergeable": "CONFLICTING",
+        "headRefName": "improve_docs",
+        "headRefOid": "shafoo",
+        "baseRefName": "develop",
+        "baseRefOid": "shabar",
+        "potentialMergeCommit": None,
+        "commits": {"nodes": [{"commit": {
+            "checkSuites": {"nodes": [{"check0": {"nodes": [{"name": "style", "conclusion": "SUCCESS"}]},
+                                       "check1": {"nodes": []}}]},
+            "status": {"contexts": [{"context": "ci/gitlab-ci", "state": "PENDING",
+                                     "description": "Pipeline is pending", "targetUrl": "url"}]},
+        }}]},
+    }
+    response = Mock()
+    response.json.return_value = {"data": {"repository": {"pullRequests": {
+        "pageInfo": {"hasNextPage": False, "endCursor": None}, "nodes": [node]}}}}
+    bridge = SpackCIBridge.SpackCIBridge(github_project="spack/spack", use_graphql=True,
+                                         prereq_checks=["style", "flake8"])
+    bridge.py_gh_repo = Mock()
+    with patch.object(SpackCIBridge.GithubConnection.shared_session, "post", return_value=response) as mock_post:
+        pulls = bridge.get_open_prs()
+    assert mock_post.call_args.kwargs["json"]["variables"]["name"] == "spack"
+    query = mock_post.call_args.kwargs["json"]["query"]
+    assert 'check0: checkRuns(first: 100, filterBy: {checkName: "style"})' in query
+    assert 'check1: checkRuns(first: 100, filterBy: {checkName: "flake8"})' in query
+    bridge.py_gh_repo.get_pulls.assert_not_called()
+
+    assert len(pulls) == 1
+    assert pulls[0].head.sha == "shafoo"
+    assert pulls[0].base.ref == "develop"
+    assert pulls[0].updated_at == datetime(2020, 8, 26, 17, 30)
+    assert pulls[0].merge_commit_sha is None
+    assert bridge.pr_mergeable == {1: "CONFLICTING"}
+    assert [(run.name, run.conclusion) for run in bridge.get_check_runs("shafoo")] == [("style", "success")]
+    assert [(s.context, s.state) for s in bridge.get_commit_statuses("shafoo")] == [("ci/gitlab-ci", "pending")]
+
+
+def test_state_file_skips_known_prs_and_statuses(capfd):
+    """Test that decisions and statuses recorded in the state file are reused instead of recomputed."""
+    dt = datetime.now()
+    github_pr_response = [
+        AttrDict({
+            "number": 1,
+            "draft": False,
+            "updated_at": dt,
+            "head": {"ref": "improve_docs", "sha": "shafoo"},
+            "base": {"ref": "main", "sha": "shabar"},
+        }),
+        AttrDict({
+            "number": 2,
+            "draft": False,
+            "updated_at": dt,
+            "head": {"ref": "fix_test", "sha": "shagah"},
+            "base": {"ref": "main", "sha": "shafaz"},
+        }),
+    ]
+    gh_commit = Mock()
+    gh_commit.create_status.return_value = AttrDict({"state": "pending"})
+    gh_commit.get_combined_status.return_value = AttrDict({"statuses": []})
+    gh_repo = Mock()
+    gh_repo.get_pulls.return_value = github_pr_response
+    gh_repo.get_commit.return_value = gh_commit
+
+    bridge = SpackCIBridge.SpackCIBridge(main_branch="main", state_file=":memory:")
+    bridge.py_gh_repo = gh_repo
+    bridge.py_github = py_github
+    bridge.latest_tested_main_commit = "shamain"
+    bridge.state.set_pr("pr1_improve_docs", "shafoo", "shaold", "pushed")
+    bridge.state.set_pr("pr2_fix_test", "shagah", "shamain", "base")
+    bridge.state.set_pr("pr3_closed", "shaclosed", "shamain", "pushed")
+
+    with patch("subprocess.run") as mock_run:
+        all_open_prs, open_prs = bridge.list_github_prs()
+        mock_run.assert_not_called()
+    assert all_open_prs["backlogged"] == [False, "base"]
+    assert open_prs["pr_strings"] == []
+    assert bridge.state.get_pr("pr3_closed") is None
+
+    bridge.create_status_for_commit("shagah", "pr2_fix_test", "pending", "url", "desc")
+    bridge.create_status_for_commit("shagah", "pr2_fix_test", "pending", "url", "desc")
+    assert gh_commit.get_combined_status.call_count == 1
+    assert gh_commit.create_status.call_count == 1
+    out, err = capfd.readouterr()
+    assert "Not posting duplicate status to pr2_fix_test / shagah" in out
+
+
+def test_reset_git_mirror(tmp_path):
+    """Test that reusing the git mirror throws away the work tree and refs of the last run."""
+    import subprocess
+
+    def git(*args):
+        return subprocess.run(["git", *args], check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        git("init", "-q")
+        git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q", "--allow-empty", "-m", "A")
+        sha = git("rev-parse", "HEAD").strip()
+        git("checkout", "-q", "-b", "pr1_readme")
+        git("tag", "v1.0")
+        for ref in ("refs/remotes/develop", "refs/remotes/github/develop", "refs/remotes/gitlab/pr1_readme"):
+            git("update-ref", ref, sha)
+        (tmp_path / "leftover").write_text("")
+
+        bridge = SpackCIBridge.SpackCIBridge(git_mirror=str(tmp_path))
+        bridge.reset_git_mirror()
+
+        assert git("for-each-ref", "--format=%(refname)").split() == [
+            "refs/remotes/github/develop",
+            "refs/remotes/gitlab/pr1_readme",
+        ]
+        assert git("rev-parse", "HEAD").strip() == sha
+        assert not (tmp_path / "leftover").exists()
+    finally:
+        os.chdir(cwd)
+
+
+def test_setup_git_mirror_updates_remotes(tmp_path):
+    """Test that a reused git mirror gets the current remote URLs, and never keeps the GitHub token."""
+    import subprocess
+
+    def git(*args):
+        return subprocess.run(["git", *args], check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+
+    for repo in ("github.git", "gitlab.git"):
+        git("init", "-q", "--bare", str(tmp_path / repo))
+    mirror = tmp_path / "mirror"
+    git("init", "-q", str(mirror))
+    git("-C", str(mirror), "remote", "add", "github", "https://oldtoken@github.com/spack/spack.git")
+    git("-C", str(mirror), "remote", "add", "gitlab", "git@gitlab.spack.io:spack/old.git")
+
+    with patch.dict(os.environ, {"GITHUB_TOKEN": "newtoken"}):
+        bridge = SpackCIBridge.SpackCIBridge(github_project="spack/spack", git_mirror=str(mirror))
+    assert bridge.github_repo == "https://github.com/spack/spack.git"
+    bridge.github_repo = "file://{0}".format(tmp_path / "github.git")
+    bridge.gitlab_repo = "file://{0}".format(tmp_path / "gitlab.git")
+
+    cwd = os.getcwd()
+    try:
+        bridge.setup_git_mirror()
+    finally:
+        os.chdir(cwd)
+    assert git("-C", str(mirror), "remote", "get-url", "github").strip() == bridge.github_repo
+    assert git("-C", str(mirror), "remote", "get-url", "gitlab").strip() == bridge.gitlab_repo
+    config = (mirror / ".git" / "config").read_text()
+    assert "oldtoken" not in config and "newtoken" not in config
+
+
+def test_fetch_github_refspecs_bisects_failures(capfd):
+    """Test that refspecs that can't be fetched are found without fetching every refspec on its own,
+    and that PRs without a merge commit aren't fetched at all."""
+    import subprocess
+    bridge = SpackCIBridge.SpackCIBridge()
+    refspecs = ["sha{0}:pr{0}".format(n) for n in range(1, 9)]
+    bad = {"sha3:pr3", "sha4:pr4"}
+
+    def fake_run(args, **kwargs):
+        if bad & set(args):
+            raise subprocess.CalledProcessError(128, args)
+        return AttrDict({"stdout": b"", "returncode": 0})
+
+    with patch("subprocess.run", side_effect=fake_run) as mock_run:
+        assert bridge.fetch_github_refspecs(refspecs) == bad
+    fetches = [call.args[0] for call in mock_run.call_args_list]
+    assert len(fetches) < len(refspecs)
+    # Only the fetches up to the first one that succeeded need to unshallow the repository.
+    unshallowed = [args for args in fetches if "--unshallow" in args]
+    assert unshallowed == fetches[:3]
+    assert unshallowed[-1] == ["git", "fetch", "-q", "--unshallow", "github", *refspecs[:2]]
+    out, err = capfd.readouterr()
+    assert "Failed to fetch 8 refs from GitHub at once, splitting them up" in out
+
+    pulls = [AttrDict({"number": 1, "merge_commit_sha": "sha1"}), AttrDict({"number": 2, "merge_commit_sha": None})]
+    merge_commit_prs = [("pr{0}_branch".format(pull.number), pull) for pull in pulls]
+    pr_dict = {pr_string: {"push": True, "backlogged": False} for pr_string, pull in merge_commit_prs}
+    with patch.object(bridge, "fetch_github_refspecs", return_value=set()) as mock_fetch:
+        bridge.build_pr_branches(pr_dict, [], merge_commit_prs)
+    mock_fetch.assert_called_once_with(["sha1:pr1_branch"])
+    assert list(pr_dict) == ["pr1_branch"]
+    out, err = capfd.readouterr()
+    assert "Skip pushing pr2_branch because GitHub has no merge commit for it" in out
+
+
+def test_merge_main_branch_prs_in_parallel(capfd):
+    """Test that PRs merged in parallel are reported and committed in a deterministic order."""
+    import time
+    pulls = [
+        AttrDict({"number": n, "head": {"ref": "branch{0}".format(n), "sha": "sha{0}".format(n)}})
+        for n in range(1, 6)
+    ]
+    main_branch_prs = [("pr{0}_branch{0}".format(pull.number), pull) for pull in pulls]
+    pr_dict = {pr_string: {"push": True, "backlogged": False} for pr_string, pull in main_branch_prs}
+
+    def fake_run(args, **kwargs):
+        if args[1] == "merge-tree":
+            # Finish the merges in the reverse order, make the second PR conflict, and fail to merge the fifth.
+            n = int(args[-1][3:])
+            time.sleep(0.01 * (6 - n))
+            if n == 5:
+                return AttrDict({"returncode": 128, "stdout": b"", "stderr": b"fatal: bad object sha5\n"})
+            return AttrDict({"returncode": 1 if n == 2 else 0, "stdout": "tree{0}\n".format(n).encode()})
+        if args[1] == "for-each-ref":
+            return AttrDict({"stdout": "".join("temporary_{0} {1}\n".format(pr_string, pull.head.sha)
+                                               for pr_string, pull in main_branch_prs).encode()})
+        return AttrDict({"stdout": b""})
+
+    bridge = SpackCIBridge.SpackCIBridge(main_branch="develop", merge_workers=4, state_file=":memory:")
+    bridge.latest_tested_main_commit = "shamain"
+    with patch("subprocess.run", side_effect=fake_run) as mock_run:
+        bridge.merge_main_branch_prs(pr_dict, main_branch_prs)
+        fast_import_input = mock_run.call_args.kwargs["input"].decode("utf-8")
+
+    assert list(pr_dict) == ["pr1_branch1", "pr3_branch3", "pr4_branch4"]
+    assert bridge.unmergeable_shas == ["sha2"]
+    # Only a conflict is remembered, an error is retried in the next run.
+    assert bridge.state.get_pr("pr2_branch2") == ("sha2", "shamain", "unmergeable")
+    assert bridge.state.get_pr("pr5_branch5") is None
+    assert [line for line in fast_import_input.splitlines() if line.startswith("M ")] == [
+        'M 040000 tree1 ""', 'M 040000 tree3 ""', 'M 040000 tree4 ""']
+    out, err = capfd.readouterr()
+    assert "Failed to run git merge-tree for PR 5 (branch5). Skipping: fatal: bad object sha5" in out
+    assert out.endswith("Merge succeeded, ready to push pr1_branch1 to GitLab for CI pipeline testing\n"
+                        "Merge succeeded, ready to push pr3_branch3 to GitLab for CI pipeline testing\n"
+                        "Merge succeeded, ready to push pr4_branch4 to GitLab for CI pipeline testing\n")
+
+
+def test_merge_main_branch_prs_without_untested_commits(capfd):
+    """Test that PRs are skipped without recording a verdict when the untested main commits can't be listed."""
+    import subprocess
+    pull = AttrDict({"number": 1, "head": {"ref": "a", "sha": "shaa"}})
+    pr_dict = {"pr1_a": {"push": True, "backlogged": False}}
+
+    def fake_run(args, **kwargs):
+        if args[1] == "rev-list":
+            raise subprocess.CalledProcessError(128, args)
+        return AttrDict({"stdout": b"temporary_pr1_a shaa\n"})
+
+    bridge = SpackCIBridge.SpackCIBridge(main_branch="develop", state_file=":memory:")
+    bridge.latest_tested_main_commit = "shamain"
+    with patch("subprocess.run", side_effect=fake_run):
+        bridge.merge_main_branch_prs(pr_dict, [("pr1_a", pull)])
+    assert pr_dict == {}
+    assert bridge.state.get_pr("pr1_a") is None
+    out, err = capfd.readouterr()
+    assert "Failed to find the develop commits newer than shamain. Skipping 1 PRs" in out
+
+
+def test_ancestry_cache(tmp_path):
+    """Test that ancestry checks are answered from the cache, also in a later run with the same state file."""
+    state_file = str(tmp_path / "state.db")
+
+    def fake_run(args, **kwargs):
+        if args[1] == "rev-list":
+            return AttrDict({"stdout": b"shanew shaold\nshaold shatested\n"})
+        if args[1] == "for-each-ref":
+            return AttrDict({"stdout": b"temporary_pr1_a\n"})
+        return AttrDict({"stdout": b""})
+
+    branches = {"temporary_pr1_a": "shaa", "temporary_pr2_b": "shab"}
+    for expected_for_each_ref_calls in (1, 0):
+        bridge = SpackCIBridge.SpackCIBridge(main_branch="develop", state_file=state_file)
+        bridge.latest_tested_main_commit = "shatested"
+        with patch("subprocess.run", side_effect=fake_run) as mock_run:
+            assert bridge.find_branches_with_untested_main_commits(branches) == {"temporary_pr1_a"}
+            assert bridge.find_branches_with_untested_main_commits(branches) == {"temporary_pr1_a"}
+            for_each_ref_calls = [call for call in mock_run.call_args_list if call.args[0][1] == "for-each-ref"]
+        assert len(for_each_ref_calls) == expected_for_each_ref_calls
+    assert bridge.ancestry_cache == {
+        ("shaold", "shaa"): True,
+        ("shaold", "shab"): False,
+    }
+
+
+def test_debounced_queue():
+    """Test that bursts of events for the same item are coalesced, and items are handed out once due."""
+    queue = SpackCIBridge.DebouncedQueue(0.05)
+    queue.put(("pr", 1))
+    queue.put(("pr", 2))
+    queue.put(("pr", 1))
+    assert queue.get(timeout=0) is None
+    assert queue.get(timeout=1) == ("pr", 2)
+    assert queue.get(timeout=1) == ("pr", 1)
+    assert queue.get(timeout=0.1) is None
+
+    queue.put(("ref", "refs/heads/develop"))
+    queue.clear()
+    assert queue.get(timeout=0.1) is None
+
+
+def test_webhook_items_without_prereq_checks():
+    """Test that check_run webhooks are ignored when no prerequisite checks are configured."""
+    # --prereq-check defaults to False.
+    bridge = SpackCIBridge.SpackCIBridge(main_branch="develop", prereq_checks=False)
+    payload = {"action": "completed", "check_run": {"name": "style", "pull_requests": [{"number": 6}]}}
+    assert bridge.webhook_items("github", "check_run", payload) == []
+    assert bridge.webhook_items("github", "pull_request",
+                                {"action": "synchronize", "pull_request": {"number": 5}}) == [("pr", 5)]
+
+
+def test_webhook_handler():
+    """Test that webhooks get verified and queue what they are about."""
+    import hashlib
+    import hmac
+    import threading
+    import urllib.error
+    import urllib.request
+
+    bridge = SpackCIBridge.SpackCIBridge(main_branch="develop", prereq_checks=["style"],
+                                         disable_status_post=False)
+    server = SpackCIBridge.ThreadingHTTPServer(("127.0.0.1", 0), SpackCIBridge.WebhookHandler)
+    server.bridge = bridge
+    server.queue = Mock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+    def post(headers, payload):
+        body = json.dumps(payload).encode()
+        request = urllib.request.Request(url, data=body, headers=headers)
+        if "X-GitHub-Event" in headers:
+            signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+            request.add_header("X-Hub-Signature-256", "sha256=" + signature)
+        try:
+            return urllib.request.urlopen(request).status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    os.environ["GITHUB_WEBHOOK_SECRET"] = "secret"
+    os.environ["GITLAB_WEBHOOK_TOKEN"] = "token"
+    try:
+        assert post({"X-GitHub-Event": "pull_request"},
+                    {"action": "synchronize", "pull_request": {"number": 5}}) == 202
+        assert post({"X-GitHub-Event": "check_run"},
+                    {"action": "completed", "check_run": {"name": "style", "pull_requests": [{"number": 6}]}}) == 202
+        assert post({"X-GitHub-Event": "push"}, {"ref": "refs/tags/v1.0"}) == 202
+        assert post({"X-Gitlab-Event": "Pipeline Hook", "X-Gitlab-Token": "token"},
+                    {"object_attributes": {"ref": "develop", "status": "success"}}) == 202
+        assert [c.args[0] for c in server.queue.put.call_args_list] == [
+            ("pr", 5), ("pr", 6), ("ref", "refs/tags/v1.0"), ("status", "develop"), ("sync",)]
+
+        os.environ["GITHUB_WEBHOOK_SECRET"] = "another secret"
+        assert post({"X-GitHub-Event": "pull_request"},
+                    {"action": "synchronize", "pull_request": {"number": 5}}) == 401
+        assert post({"X-Gitlab-Event": "Pipeline Hook"}, {"object_attributes": {}}) == 401
+        assert post({}, {}) == 400
+
+        # Unsigned requests are rejected, even when no secret or token is configured.
+        unsigned = urllib.request.Request(url, data=b"{}", headers={"X-GitHub-Event": "push"})
+        try:
+            urllib.request.urlopen(unsigned)
+        except urllib.error.HTTPError as e:
+            assert e.code == 401
+        else:
+            assert False, "unsigned webhook was accepted"
+        del os.environ["GITHUB_WEBHOOK_SECRET"]
+        assert post({"X-GitHub-Event": "push"}, {"ref": "refs/tags/v1.0"}) == 401
+        os.environ["GITLAB_WEBHOOK_TOKEN"] = ""
+        assert post({"X-Gitlab-Event": "Pipeline Hook", "X-Gitlab-Token": ""},
+                    {"object_attributes": {"ref": "develop", "status": "success"}}) == 401
+        assert server.queue.put.call_count == 5
+    finally:
+        server.shutdown()
+        os.environ.pop("GITHUB_WEBHOOK_SECRET", None)
+        os.environ.pop("GITLAB_WEBHOOK_TOKEN", None)
+
+
+def test_skip_unchanged_refs(capfd):
+    """Test that only protected branches and tags that differ between GitHub and GitLab get pushed."""
+    bridge = SpackCIBridge.SpackCIBridge()
+    bridge.github_ref_shas = {
+        "refs/heads/develop": "shadevelop",
+        "refs/heads/releases/v1": "shanew",
+        "refs/tags/v1.0": "shav1.0",
+        "refs/tags/v1.1": "shav1.1",
+        "refs/tags/v2.0": "shav2.0",
+    }
+    ls_remote = (b"shadevelop\trefs/heads/develop\n"
+                 b"shaold\trefs/heads/releases/v1\n"
+                 b"shatag\trefs/tags/v1.0\n"
+                 b"shav1.0\trefs/tags/v1.0^{}\n"
+                 b"shav1.1\trefs/tags/v1.1\n")
+    with patch("subprocess.run", return_value=AttrDict({"stdout": ls_remote})):
+        branches, tags = bridge.skip_unchanged_refs(["develop", "releases/v1"], ["v1.0", "v1.1", "v2.0"])
+    assert branches == ["releases/v1"]
+    assert tags == ["v2.0"]
+    out, err = capfd.readouterr()
+    assert "Skip pushing 1 protected branches and 2 tags that are up to date on GitLab" in out
+
+
+def test_push_to_gitlab_retries_failed_refs(capfd):
+    """Test that refs are pushed in chunks, and that only the refs that failed to push are retried."""
+    bridge = SpackCIBridge.SpackCIBridge(state_file=":memory:", push_workers=2, push_chunk_size=2)
+    bridge.reset_run_state()
+    rejected = set()
+
+    def push(args, **kwargs):
+        refspecs = args[6:]
+        lines = ["To gitlab.spack.io:spack/spack.git"]
+        for refspec in refspecs:
+            source, destination = (bridge.destination_ref(ref) for ref in refspec.split(":"))
+            if refspec == "pr2:pr2" and refspec not in rejected:
+                rejected.add(refspec)
+                lines.append("!\t{0}:{1}\t[remote rejected] (pre-receive hook declined)".format(source, destination))
+            else:
+                lines.append("*\t{0}:{1}\t[new branch]".format(source, destination))
+        lines.append("Done")
+        returncode = 1 if any(line.startswith("!") for line in lines) else 0
+        return AttrDict({"stdout": "\n".join(lines).encode(), "stderr": b"", "returncode": returncode})
+
+    open_refspecs = ["pr1:pr1", "pr2:pr2", "develop:develop"]
+    open_prs = {"pr_strings": ["pr1", "pr2"], "head_shas": ["shapr1", "shapr2"]}
+    with patch("subprocess.run", side_effect=push) as mock_run:
+        bridge.push_to_gitlab(open_refspecs, open_prs)
+    pushes = [call.args[0][6:] for call in mock_run.call_args_list]
+    assert sorted(pushes[:2]) == [["develop:develop"], ["pr1:pr1", "pr2:pr2"]]
+    assert pushes[2:] == [["pr2:pr2"]]
+    assert bridge.state.get_pr("pr1") == ("shapr1", None, "pushed")
+    assert bridge.state.get_pr("pr2") == ("shapr2", None, "pushed")
+    out, err = capfd.readouterr()
+    assert "! pr2:pr2 [remote rejected] (pre-receive hook declined)" in out
+    assert "Retrying 1 refs that failed to push" in out
+
+
+def test_push_to_gitlab_gives_up_on_failed_refs(capfd):
+    """Test that refs that keep failing to push get no status posted, and fail the sync."""
+    bridge = SpackCIBridge.SpackCIBridge(state_file=":memory:")
+    bridge.reset_run_state()
+    bridge.py_github = AttrDict({"rate_limiting": (5000, 5000)})
+
+    open_prs = {"pr_strings": ["pr1"], "base_shas": ["shabase"], "head_shas": ["shapr1"], "backlogged": [False]}
+    error = "error: failed to push some refs to 'gitlab.spack.io:spack/spack.git'\n"
+    with patch.object(bridge, "push_chunk", return_value=({}, 0.0, error)) as mock_push:
+        bridge.push_to_gitlab(["pr1:pr1", "github/develop:develop"], open_prs)
+    assert mock_push.call_count == 3
+    assert bridge.unpushed_refs == {"refs/heads/pr1", "refs/heads/develop"}
+    assert bridge.state.get_pr("pr1") is None
+
+    with patch.object(bridge, "post_status_for_branch") as mock_post:
+        bridge.post_pipeline_status(open_prs, ["develop"])
+    mock_post.assert_not_called()
+
+    try:
+        bridge.raise_for_unpushed_refs()
+    except Exception as e:
+        assert str(e) == "Failed to push 2 refs to GitLab: refs/heads/develop refs/heads/pr1"
+    else:
+        assert False, "unpushed refs did not fail the sync"
+    out, err = capfd.readouterr()
+    assert "Failed to push 2 refs to GitLab: pr1:pr1 github/develop:develop" in out
+
+
+def test_run_metrics(tmp_path):
+    """Test that phases are timed, git commands are counted, and the run summary gets written."""
+    import subprocess
+    metrics_file = tmp_path / "metrics.json"
+    bridge = SpackCIBridge.SpackCIBridge(metrics_file=str(metrics_file))
+    bridge.py_github = AttrDict({"rate_limiting": (4999, 5000)})
+    bridge.reset_run_state()
+    metrics = SpackCIBridge.run_metrics
+    subprocess.run(["git", "init", "-q", str(tmp_path / "repo")])
+    metrics.reset()
+    for _ in range(2):
+        # Measuring the fetched bytes runs git too, but those commands aren't counted.
+        with metrics.phase("fetch"), bridge.count_fetched_bytes(str(tmp_path / "repo")):
+            subprocess.run(["git", "--version"], stdout=subprocess.DEVNULL)
+    metrics.count("bytes_pushed", 1024)
+
+    bridge.write_run_summary(metrics.summary())
+    summary = json.loads(metrics_file.read_text())
+    assert list(summary["phases"]) == ["fetch"]
+    assert summary["counters"]["git_commands"] == 2
+    assert summary["counters"]["bytes_pushed"] == 1024
+    assert summary["counters"]["github_requests"] == 0
+    assert summary["github_rate_limit_remaining"] == 4999
+
+    bridge.reset_run_state()
+    assert metrics.summary()["counters"]["git_commands"] == 0
+
+
+def test_sync_reports_without_sentry(tmp_path):
+    """Test that a sync gets through reporting its metrics when Sentry was never initialized."""
+    import contextlib
+    import sentry_sdk
+    assert sentry_sdk.Hub.current.client is None
+
+    metrics_file = tmp_path / "metrics.json"
+    bridge = SpackCIBridge.SpackCIBridge(metrics_file=str(metrics_file))
+    bridge.py_github = AttrDict({"rate_limiting": (5000, 5000), "rate_limiting_resettime": 1700000000})
+    with patch.object(bridge, "git_repo", return_value=contextlib.nullcontext()), \
+            patch.object(bridge, "find_main_branch_pipelines"), \
+            patch.object(bridge, "list_github_protected_branches", return_value=[]), \
+            patch.object(bridge, "list_github_tags", return_value=[]), \
+            patch.object(bridge, "skip_unchanged_refs", return_value=([], [])), \
+            patch.object(bridge, "index_tested_shas"), \
+            patch("subprocess.run", return_value=AttrDict({"stdout": b"", "returncode": 1})):
+        bridge.sync()
+    summary = json.loads(metrics_file.read_text())
+    assert summary["github_rate_limit_remaining"] == 5000
+    assert "main_pipelines" in summary["phases"]
+
+
+def test_prune_closed_prs(capfd):
+    """Test that GitLab branches and S3 mirrors of closed PRs get deleted in batches."""
+    bridge = SpackCIBridge.SpackCIBridge(pr_mirror_bucket="spack-binaries-prs")
+    bridge.reset_run_state()
+    bridge.open_pr_strings = ["pr1_open", "pr2_fix/typo"]
+
+    def fake_run(args, **kwargs):
+        if args[1] == "for-each-ref":
+            return AttrDict({"stdout": b"develop\npr1_open\npr2_fix/typo\npr3_closed\npr4_gone/away\n"})
+        stdout = "".join("-\t:refs/heads/{0}\t[deleted]\n".format(refspec[1:]) for refspec in args[6:])
+        return AttrDict({"stdout": stdout.encode(), "stderr": b"", "returncode": 0})
+
+    s3 = Mock()
+    prefixes = [{"CommonPrefixes": [{"Prefix": prefix} for prefix in
+                                    ("pr1_open/", "pr2_fix/", "pr3_closed/", "pr5_old/", "develop/")]}]
+    objects = {
+        "pr3_closed/": [{"Contents": [{"Key": "pr3_closed/{0}".format(i)} for i in range(1500)]}],
+        "pr5_old/": [{"Contents": [{"Key": "pr5_old/index.json"}]}],
+    }
+    s3.get_paginator.return_value.paginate.side_effect = \
+        lambda Bucket, Prefix, **kwargs: prefixes if kwargs.get("Delimiter") else objects[Prefix]
+    s3.delete_objects.return_value = {}
+    with patch("subprocess.run", side_effect=fake_run) as mock_run, \
+            patch("boto3.client", return_value=s3):
+        bridge.prune_closed_prs()
+
+    assert mock_run.call_args_list[1].args[0][6:] == [":pr3_closed", ":pr4_gone/away"]
+    batches = [[obj["Key"] for obj in call.kwargs["Delete"]["Objects"]] for call in s3.delete_objects.call_args_list]
+    assert [len(batch) for batch in batches] == [1000, 501]
+    assert batches[1][-1] == "pr5_old/index.json"
+    out, err = capfd.readouterr()
+    assert "Deleted 1501 objects from spack-binaries-prs, failed to delete 0" in out
+
+    # Nothing gets deleted unless all open PRs were listed.
+    bridge.reset_run_state()
+    with patch("subprocess.run") as mock_run:
+        bridge.prune_closed_prs()
+    mock_run.assert_not_called()
+
+
+def test_github_conditional_requests():
+    """Test that GitHub API responses are revalidated with their ETag, and reused when not modified."""
+    def response(status, headers, text=""):
+        return AttrDict({"status_code": status, "headers": headers, "text": text})
+
+    bridge = SpackCIBridge.SpackCIBridge(state_file=":memory:")
+    bridge.reset_run_state()
+    cache = SpackCIBridge.GithubConnection.response_cache
+    responses = [
+        response(200, {"ETag": '"v1"', "X-RateLimit-Remaining": "4999", "Link": "<next>"}, '[{"number": 1}]'),
+        response(304, {"ETag": '"v1"', "X-RateLimit-Remaining": "4999"}),
+    ]
+    with patch.object(SpackCIBridge.GithubConnection.shared_session, "get", side_effect=responses) as mock_get:
+        for expected_headers in ({}, {"If-None-Match": '"v1"'}):
+            connection = SpackCIBridge.GithubConnection("api.github.com")
+            connection.request("GET", "/repos/spack/spack/pulls?state=open", None, {})
+            github_response = connection.getresponse()
+            assert mock_get.call_args.kwargs["headers"] == expected_headers
+            assert github_response.status == 200
+            assert github_response.read() == '[{"number": 1}]'
+            assert dict(github_response.getheaders())["Link"] == "<next>"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert bridge.state.get_response("/repos/spack/spack/pulls?state=open")["etag"] == '"v1"'
+    cache.entries.clear()
+    cache.state = None
+
+
+def test_post_status_with_tested_sha_index(capfd):
+    """Test that the PR HEAD of a tested commit is looked up locally instead of with the GitLab API."""
+    gh_commit = Mock()
+    gh_commit.create_status.return_value = AttrDict({"state": "success"})
+    gh_commit.get_combined_status.return_value = AttrDict({"statuses": []})
+    gh_repo = Mock()
+    gh_repo.get_commit.return_value = gh_commit
+
+    bridge = SpackCIBridge.SpackCIBridge()
+    bridge.py_gh_repo = gh_repo
+    bridge.find_pr_sha = Mock(return_value=None)
+    for_each_ref = b"shamerge Merge shahead into shamain\nshadevelop Update the docs (#123)\n"
+    with patch("subprocess.run", return_value=AttrDict({"stdout": for_each_ref})):
+        bridge.index_tested_shas()
+
+    def pipeline(sha):
+        return {"sha": sha, "status": "success", "updated_at": "2020-08-26T17:26:36.807Z", "web_url": "url"}
+    bridge.recent_pipelines = {
+        "pr1_readme": [pipeline("shamerge")],
+        "develop": [pipeline("shadevelop")],
+        "pr2_docs": [pipeline("shaunknown")],
+    }
+    for branch in ("pr1_readme", "develop", "pr2_docs"):
+        bridge.post_status_for_branch(branch)
+    assert [c.kwargs["sha"] for c in gh_repo.get_commit.call_args_list] == ["shahead", "shadevelop", "shaunknown"]
+    bridge.find_pr_sha.assert_called_once_with("shaunknown")
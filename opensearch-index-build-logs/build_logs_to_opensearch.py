@@ -1,23 +1,36 @@
 from __future__ import annotations
 
+import argparse
+import base64
+import binascii
+import gzip
+import hashlib
 import json
 import logging
 import os
+import queue
 import re
+import sqlite3
+import sys
 import tarfile
-from datetime import datetime
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator
 
 import boto3
 import gitlab
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import pyjson5
 import requests
 from botocore import UNSIGNED
 from botocore.client import Config
+from requests.adapters import HTTPAdapter
 
 # Authenticate the boto3 client with AWS.
 # Since the spack build cache is a public S3 bucket, we don't need credentials
@@ -34,7 +47,6 @@ db_conn = psycopg2.connect(
     user=os.environ["GITLAB_PG_USER"],
     password=os.environ["GITLAB_PG_PASS"],
 )
-cur = db_conn.cursor(cursor_factory=RealDictCursor)
 
 logging.basicConfig(level=logging.ERROR)  # Only log ERROR messages
 
@@ -47,76 +59,373 @@ OPENSEARCH_PASSWORD = os.environ["OPENSEARCH_PASSWORD"]
 
 TODAY = datetime.today()
 
-gl = gitlab.Gitlab("https://gitlab.spack.io", os.environ["GITLAB_TOKEN"])
+# Concurrency limits for each stage of the indexing pipeline (see `main()`). Every stage reads
+# from a bounded queue of QUEUE_SIZE items, so a slow stage applies backpressure all the way
+# back to the S3 key listing.
+DB_LOOKUP_WORKERS = int(os.environ.get("DB_LOOKUP_WORKERS", 4))
+GITLAB_WORKERS = int(os.environ.get("GITLAB_WORKERS", 8))
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 16))
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", 4))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 256))
 
+# Documents are sent to OpenSearch in `_bulk` requests of at most BULK_MAX_DOCS documents or
+# BULK_MAX_BYTES bytes, whichever is reached first. Partially filled batches are sent after
+# BULK_FLUSH_INTERVAL seconds.
+BULK_MAX_DOCS = int(os.environ.get("BULK_MAX_DOCS", 500))
+BULK_MAX_BYTES = int(os.environ.get("BULK_MAX_BYTES", 5 * 1024 * 1024))
+BULK_FLUSH_INTERVAL = float(os.environ.get("BULK_FLUSH_INTERVAL", 5))
+BULK_MAX_RETRIES = int(os.environ.get("BULK_MAX_RETRIES", 5))
 
-def get_gitlab_build_job_metadata(build_hash: str) -> dict[str, Any]:
+# Optional path of a local snapshot of the build hashes that are already indexed. When set, only
+# the hashes indexed since the snapshot was written are fetched from OpenSearch at startup.
+INDEXED_HASHES_SNAPSHOT = os.environ.get("INDEXED_HASHES_SNAPSHOT")
+
+# Optional path of the watermark of the previous run's S3 listing. When set, the indexer runs
+# incrementally and only processes objects that are new or have changed since that run.
+LISTING_WATERMARK = os.environ.get("LISTING_WATERMARK")
+
+# Where to cache the metadata of gitlab jobs across runs, and how many jobs to keep there. By
+# default the cache only lasts for a single run.
+GITLAB_JOB_CACHE = os.environ.get("GITLAB_JOB_CACHE", ":memory:")
+GITLAB_JOB_CACHE_SIZE = int(os.environ.get("GITLAB_JOB_CACHE_SIZE", 1_000_000))
+
+# Share one pool of keep-alive connections between all threads talking to gitlab. main() sizes
+# the pool for the number of gitlab workers once it knows it.
+gitlab_session = requests.Session()
+gl = gitlab.Gitlab(
+    "https://gitlab.spack.io", os.environ["GITLAB_TOKEN"], session=gitlab_session
+)
+# The project the build jobs run in. It's never modified, so there's no need to fetch it.
+gitlab_project = gl.projects.get(2, lazy=True)
+
+
+# CI job names look like "(specs) <package>/<7 char hash> <version> <compiler> <os_arch> ...".
+JOB_NAME_HASH_REGEX = re.compile(r"/([a-z0-9]{7})(?:\s|$)")
+
+
+def load_build_jobs() -> dict[str, tuple[int, str, str]]:
     """
-    Get metadata from the gitlab job that performed this build.
+    Map the shortened build hash of every successful CI job to the id, compiler and os/arch of
+    that job.
 
-    Searches metabase for the gitlab job with the given build hash,
-    then uses the resulting job ID to get the job's metadata from
-    the gitlab API.
+    This is a single pass over ci_builds, streamed through a server-side cursor. When several
+    jobs built the same hash, the most recent one wins. Only the parts of the job name that are
+    needed are kept, and since few distinct compilers and os/archs exist they are interned.
     """
-    shortened_build_hash = build_hash[:7]
+    build_jobs: dict[str, tuple[int, str, str]] = {}
+    with db_conn.cursor(name="ci_builds_by_hash") as cur:
+        cur.itersize = 10000
+        cur.execute(
+            """
+            SELECT id, name
+            FROM ci_builds
+            WHERE status = 'success'
+            """
+        )
+        for job_id, job_name in cur:
+            match = JOB_NAME_HASH_REGEX.search(job_name)
+            if match is None:
+                continue
+            shortened_build_hash = match.group(1)
+            existing = build_jobs.get(shortened_build_hash)
+            if existing is not None and existing[0] > job_id:
+                continue
+            fields = job_name.split()
+            if len(fields) < 5:
+                continue
+            build_jobs[shortened_build_hash] = (
+                job_id,
+                sys.intern(fields[3].replace("@", "-")),
+                sys.intern(fields[4]),
+            )
+    return build_jobs
 
-    cur.execute(
-        """
-        SELECT id
-        FROM ci_builds
-        WHERE name LIKE '%%' || %(hash)s || '%%'
-        AND status = 'success'
-        ORDER BY id DESC
-        """,
-        {"hash": shortened_build_hash},
-    )
-    results = [dict(r) for r in cur.fetchall()]
-    gitlab_job_id = int(results[0]["id"])
-    project = gl.projects.get(2)
-    job = project.jobs.get(gitlab_job_id)
-    return json.loads(job.to_json())
-
-
-def post_logs(log_data):
-    """Post the given JSON log data to OpenSearch."""
-
-    def _convert_booleans_to_strings(obj):
-        if isinstance(obj, bool):
-            return str(obj).lower()
-        if isinstance(obj, (list, tuple)):
-            return [_convert_booleans_to_strings(item) for item in obj]
-        if isinstance(obj, dict):
-            return {
-                key: _convert_booleans_to_strings(value) for key, value in obj.items()
-            }
-        return obj
-
-    res = requests.post(
-        f"{OPENSEARCH_ENDPOINT}/pipeline-logs-{TODAY.strftime('%Y.%m.%d')}/_doc",
-        data=json.dumps(_convert_booleans_to_strings(log_data)),
-        headers={"Content-Type": "application/json"},
-        auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
-    )
-    res.raise_for_status()
+
+class JobMetadataCache:
+    """
+    LRU cache of gitlab job metadata keyed by job id, stored in a SQLite database.
+
+    Only finished jobs are cached, since their metadata no longer changes.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = GITLAB_JOB_CACHE,
+        max_entries: int = GITLAB_JOB_CACHE_SIZE,
+    ):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                metadata TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_last_used ON jobs (last_used)")
+        self._db.commit()
+
+    def get(self, job_id: int) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT metadata FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE jobs SET last_used = ? WHERE id = ?", (time.time(), job_id)
+            )
+            return json.loads(row[0])
+
+    def put(self, job_id: int, metadata: dict[str, Any]):
+        if not metadata.get("finished_at"):
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, metadata, last_used) VALUES (?, ?, ?)",
+                (job_id, json.dumps(metadata), time.time()),
+            )
+
+    def close(self):
+        """Evict the least recently used jobs over `max_entries` and save the cache."""
+        with self._lock:
+            self._db.execute(
+                """
+                DELETE FROM jobs WHERE id IN (
+                    SELECT id FROM jobs ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self._db.commit()
+            self._db.close()
+        print(f"gitlab job metadata cache: {self.hits} hits, {self.misses} misses")
+
+
+def get_gitlab_build_job_metadata(
+    gitlab_job_id: int, cache: JobMetadataCache
+) -> dict[str, Any]:
+    """Get metadata from the gitlab job that performed a build, from the cache if possible."""
+    metadata = cache.get(gitlab_job_id)
+    if metadata is None:
+        metadata = gitlab_project.jobs.get(gitlab_job_id).asdict()
+        cache.put(gitlab_job_id, metadata)
+    return metadata
+
+
+def get_index_name() -> str:
+    """Return the name of the index that documents are uploaded to today."""
+    return f"pipeline-logs-{TODAY.strftime('%Y.%m.%d')}"
+
+
+def _convert_booleans_to_strings(obj):
+    if isinstance(obj, bool):
+        return str(obj).lower()
+    if isinstance(obj, (list, tuple)):
+        return [_convert_booleans_to_strings(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _convert_booleans_to_strings(value) for key, value in obj.items()}
+    return obj
+
+
+class BulkIndexer:
+    """
+    Buffer documents and upload them to an OpenSearch index with the `_bulk` API.
+
+    A batch is sent as soon as it holds `max_docs` documents or `max_bytes` bytes, and in any
+    case every `flush_interval` seconds. Items the cluster rejects with a retryable status are
+    resent (with exponential backoff) up to `max_retries` times; all other failures are logged.
+    The hashes of successfully indexed documents are added to `indexed_hashes`, if given.
+
+    Documents are indexed with their build hash as id, so indexing a build twice on the same day
+    overwrites the first document. With `replace_existing`, copies of the documents in the
+    indices of previous days are deleted as well.
+
+    Use it as a context manager so that the remaining documents are flushed at shutdown.
+    """
+
+    # Per-item statuses that indicate the cluster was busy rather than the document being bad.
+    RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+    def __init__(
+        self,
+        index: str,
+        max_docs: int = BULK_MAX_DOCS,
+        max_bytes: int = BULK_MAX_BYTES,
+        flush_interval: float = BULK_FLUSH_INTERVAL,
+        max_retries: int = BULK_MAX_RETRIES,
+        indexed_hashes: IndexedHashes | None = None,
+        replace_existing: bool = False,
+    ):
+        self.index = index
+        self.indexed_hashes = indexed_hashes
+        self.replace_existing = replace_existing
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        self.session.auth = (OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD)
+        self.session.headers["Content-Type"] = "application/x-ndjson"
+
+        # Each buffered item is a (build hash, NDJSON action + source lines) pair.
+        self._buffer: list[tuple[str, bytes]] = []
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+
+        self.docs_indexed = 0
+        self.bytes_indexed = 0
+        self.docs_failed = 0
+        self._stats_lock = threading.Lock()
+        self._start_time = time.monotonic()
+
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+
+    def __enter__(self) -> BulkIndexer:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, document: dict[str, Any]):
+        """Queue a document for upload, sending the current batch if it is full."""
+        action = json.dumps({"index": {"_index": self.index, "_id": document["hash"]}})
+        source = json.dumps(_convert_booleans_to_strings(document))
+        item = (document["hash"], f"{action}\n{source}\n".encode())
+
+        with self._lock:
+            self._buffer.append(item)
+            self._buffer_bytes += len(item[1])
+            if len(self._buffer) < self.max_docs and self._buffer_bytes < self.max_bytes:
+                return
+            batch = self._take_batch()
+        self._send(batch)
+
+    def flush(self):
+        """Send all buffered documents."""
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._send(batch)
+
+    def close(self):
+        """Stop the flush timer, send the remaining documents and report throughput."""
+        self._closed.set()
+        self._timer.join()
+        self.flush()
+
+        elapsed = max(time.monotonic() - self._start_time, 1e-9)
+        print(
+            f"Indexed {self.docs_indexed} documents ({self.bytes_indexed} bytes) in "
+            f"{elapsed:.1f}s: {self.docs_indexed / elapsed:.1f} docs/s, "
+            f"{self.bytes_indexed / elapsed:.0f} bytes/s, {self.docs_failed} failed"
+        )
+
+    def _take_batch(self) -> list[tuple[str, bytes]]:
+        # Must be called with self._lock held.
+        batch, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        return batch
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def _send(self, batch: list[tuple[str, bytes]]):
+        """Upload a batch, retrying only the items that failed with a retryable status."""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(2**attempt, 60))
+            try:
+                res = self.session.post(
+                    f"{OPENSEARCH_ENDPOINT}/_bulk", data=b"".join(line for _, line in batch)
+                )
+                res.raise_for_status()
+            except requests.RequestException as e:
+                status = getattr(e.response, "status_code", None)
+                if status is not None and status not in self.RETRYABLE_STATUSES:
+                    self._record_failures(batch, str(e))
+                    return
+                logging.error(f"Bulk request of {len(batch)} documents failed: {e}")
+                continue
+
+            retry: list[tuple[str, bytes]] = []
+            succeeded: list[str] = []
+            succeeded_bytes = 0
+            for item, result in zip(batch, res.json()["items"]):
+                result = result["index"]
+                if "error" not in result:
+                    succeeded.append(item[0])
+                    succeeded_bytes += len(item[1])
+                    if self.indexed_hashes is not None:
+                        self.indexed_hashes.add(item[0])
+                elif result["status"] in self.RETRYABLE_STATUSES:
+                    retry.append(item)
+                else:
+                    self._record_failures([item], str(result["error"]))
+
+            with self._stats_lock:
+                self.docs_indexed += len(succeeded)
+                self.bytes_indexed += succeeded_bytes
+
+            if self.replace_existing and succeeded:
+                self._delete_older_copies(succeeded)
+
+            if not retry:
+                return
+            batch = retry
+
+        self._record_failures(batch, f"still failing after {self.max_retries} retries")
+
+    def _delete_older_copies(self, build_hashes: list[str]):
+        """Delete the documents for the given builds from all other pipeline-logs indices."""
+        res = self.session.post(
+            f"{OPENSEARCH_ENDPOINT}/pipeline-logs*,-{self.index}/_delete_by_query",
+            params={"conflicts": "proceed"},
+            data=json.dumps({"query": {"terms": {"hash.keyword": build_hashes}}}),
+            headers={"Content-Type": "application/json"},
+        )
+        if res.status_code >= 400:
+            logging.error(
+                f"Failed to delete older copies of {len(build_hashes)} documents, "
+                f"server responded with status {res.status_code}: {res.text}"
+            )
+
+    def _record_failures(self, batch: list[tuple[str, bytes]], reason: str):
+        with self._stats_lock:
+            self.docs_failed += len(batch)
+        for build_hash, _ in batch:
+            logging.error(f"Failed to index document for build hash {build_hash}: {reason}")
 
 
 def upload_to_opensearch(
+    indexer: BulkIndexer,
     build_hash: str,
     spec_json: dict,
     install_times_json: dict,
+    gitlab_job_metadata: dict,
 ):
     """
     Given a spec.json, install_times.json, and spack-build-out files, package them all
-    into a single JSON document and POSTs them to the OpenSearch API.
+    into a single JSON document and queue it for upload to the OpenSearch API.
     """
     document: dict[str, Any] = {}
 
     document["hash"] = build_hash
     document["spec"] = spec_json["spec"]
     document["install_times"] = install_times_json
-    document["gitlab_job_metadata"] = get_gitlab_build_job_metadata(build_hash)
+    document["gitlab_job_metadata"] = gitlab_job_metadata
 
-    post_logs(document)
+    indexer.add(document)
 
 
 def create_opensearch_index():
@@ -126,7 +435,7 @@ def create_opensearch_index():
     This operation is idempotent; if an index already exists for the current date, the server will
     not create a new one.
     """
-    index_name = f"pipeline-logs-{TODAY.strftime('%Y.%m.%d')}"
+    index_name = get_index_name()
     with open(Path(__file__).parent / "pipeline_logs_mapping.json5") as fd:
         index_mappings = pyjson5.load(fd)
     res = requests.put(
@@ -146,32 +455,247 @@ def create_opensearch_index():
             logging.error(res.text)
 
 
-def fetch_and_upload_tarball(spec_json_sig_key: str):
-    logging.info(f'Fetching and uploading "{spec_json_sig_key}"...')
+class IndexedHashes:
+    """
+    The set of build hashes that already have a document in one of the pipeline-logs indices.
 
-    build_hash = spec_json_sig_key[: -len(".spec.json.sig")][-32:]
-    shortened_build_hash = build_hash[:7]
+    Spack build hashes are 32 base32 characters, so they are stored as their 20 byte decoded form.
+    Any hash that isn't valid base32 is kept as-is.
+    """
 
-    cur.execute(
+    def __init__(self, hashes: Iterable[str] = (), latest_index: str | None = None):
+        self._hashes: set[bytes | str] = set()
+        # The newest index these hashes were loaded from; documents in older indices are all
+        # accounted for.
+        self.latest_index = latest_index
+        for build_hash in hashes:
+            self.add(build_hash)
+
+    @staticmethod
+    def _pack(build_hash: str) -> bytes | str:
+        try:
+            return base64.b32decode(build_hash.upper())
+        except binascii.Error:
+            return build_hash
+
+    @staticmethod
+    def _unpack(packed: bytes | str) -> str:
+        if isinstance(packed, str):
+            return packed
+        return base64.b32encode(packed).decode().lower()
+
+    def __contains__(self, build_hash: str) -> bool:
+        return self._pack(build_hash) in self._hashes
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._unpack(packed) for packed in list(self._hashes))
+
+    def add(self, build_hash: str):
+        self._hashes.add(self._pack(build_hash))
+
+    def load_from_opensearch(self):
         """
-        SELECT name
-        FROM ci_builds
-        WHERE name LIKE '%%' || %(hash)s || '%%'
-        AND status = 'success'
-        ORDER BY id DESC
-        """,
-        {"hash": shortened_build_hash},
-    )
-    results = [dict(r) for r in cur.fetchall()]
+        Add the hashes of all documents indexed in OpenSearch, paging through them with a
+        composite aggregation on `hash.keyword`.
+
+        If `latest_index` is set, only indices at least as new as it are queried.
+        """
+        res = requests.get(
+            f"{OPENSEARCH_ENDPOINT}/_cat/indices/pipeline-logs-*",
+            params={"format": "json", "h": "index"},
+            auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
+        )
+        res.raise_for_status()
+        # Index names end in YYYY.MM.DD, so they sort chronologically.
+        indices = sorted(
+            index["index"]
+            for index in res.json()
+            if self.latest_index is None or index["index"] >= self.latest_index
+        )
+        if not indices:
+            return
+
+        query: dict[str, Any] = {
+            "size": 0,
+            "aggs": {
+                "hashes": {
+                    "composite": {
+                        "size": 10000,
+                        "sources": [{"hash": {"terms": {"field": "hash.keyword"}}}],
+                    }
+                }
+            },
+        }
+        index_pattern = "pipeline-logs*" if self.latest_index is None else ",".join(indices)
+        while True:
+            res = requests.get(
+                f"{OPENSEARCH_ENDPOINT}/{index_pattern}/_search",
+                data=json.dumps(query),
+                headers={"Content-Type": "application/json"},
+                auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
+            )
+            res.raise_for_status()
+            hashes = res.json()["aggregations"]["hashes"]
+            for bucket in hashes["buckets"]:
+                self.add(bucket["key"]["hash"])
+            if not hashes["buckets"] or "after_key" not in hashes:
+                break
+            query["aggs"]["hashes"]["composite"]["after"] = hashes["after_key"]
+
+        self.latest_index = max(indices[-1], self.latest_index or "")
+
+    @classmethod
+    def load_snapshot(cls, path: str | Path) -> IndexedHashes:
+        """
+        Read a snapshot written by `save_snapshot`. A missing snapshot results in an empty set
+        that will be loaded from scratch.
+        """
+        try:
+            with gzip.open(path, "rt") as fd:
+                header = json.loads(fd.readline())
+                return cls((line.rstrip("\n") for line in fd), header["latest_index"])
+        except FileNotFoundError:
+            return cls()
+
+    def save_snapshot(self, path: str | Path):
+        """Write the set to a gzipped file with one hash per line, after a JSON header."""
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt") as fd:
+            fd.write(json.dumps({"latest_index": self.latest_index}) + "\n")
+            for build_hash in self:
+                fd.write(build_hash + "\n")
+        os.replace(tmp_path, path)
+
+
+class ListingWatermark:
+    """
+    Record of the build cache objects processed by previous runs.
+
+    Objects are identified by an 8 byte digest of their key and ETag, so an object that is
+    re-uploaded under the same key is processed again. An object only counts as processed once
+    its build hash is indexed; anything that failed or was skipped is retried on the next run.
+    """
+
+    def __init__(self, digests: Iterable[bytes] = ()):
+        self.digests = set(digests)
+
+        # Digests of objects seen during this run that were already processed, and of the new or
+        # changed objects (along with their build hash) that were handed out for processing.
+        self._unchanged: set[bytes] = set()
+        self._pending: list[tuple[bytes, str]] = []
+
+    @staticmethod
+    def _digest(obj: dict[str, Any]) -> bytes:
+        return hashlib.blake2b(
+            f"{obj['Key']}\0{obj['ETag']}".encode(), digest_size=8
+        ).digest()
+
+    def filter(self, objects: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+        """Yield the objects from an S3 listing that have not been processed yet."""
+        for obj in objects:
+            digest = self._digest(obj)
+            if digest in self.digests:
+                self._unchanged.add(digest)
+                continue
+            self._pending.append((digest, get_build_hash(obj["Key"])))
+            yield obj
+
+    def update(self, indexed_hashes: IndexedHashes):
+        """
+        Mark the objects handed out by `filter` as processed if their build is now indexed.
+
+        Objects that were not part of this run's listing are dropped from the watermark.
+        """
+        self.digests = self._unchanged | {
+            digest for digest, build_hash in self._pending if build_hash in indexed_hashes
+        }
+        print(
+            f"{len(self._unchanged)} objects unchanged since the last run, "
+            f"{len(self.digests) - len(self._unchanged)} of {len(self._pending)} "
+            "new or changed objects processed"
+        )
+        self._unchanged, self._pending = set(), []
+
+    @classmethod
+    def load(cls, path: str | Path) -> ListingWatermark:
+        """Read a watermark written by `save`. A missing file results in a full run."""
+        try:
+            with gzip.open(path, "rt") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return cls()
+        digests = base64.b64decode(data["digests"])
+        return cls(digests[i : i + 8] for i in range(0, len(digests), 8))
+
+    def save(self, path: str | Path):
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt") as fd:
+            json.dump(
+                {"digests": base64.b64encode(b"".join(sorted(self.digests))).decode()},
+                fd,
+            )
+        os.replace(tmp_path, path)
 
-    if not len(results):
-        logging.error(f"No gitlab job entry found for {spec_json_sig_key}")
-        return
 
-    gitlab_job_name: str = results[0]["name"]
+@dataclass
+class BuildRecord:
+    """A single build cache entry as it moves through the indexing pipeline."""
 
-    compiler = gitlab_job_name.split()[3].replace("@", "-")
-    os_arch = gitlab_job_name.split()[4]
+    key: str
+    build_hash: str
+    package: str
+    compiler: str
+    os_arch: str
+    gitlab_job_id: int
+    gitlab_job_metadata: dict = field(default_factory=dict)
+    spec_json: dict = field(default_factory=dict)
+    install_times: dict = field(default_factory=dict)
+
+    @property
+    def tarball_key(self) -> str:
+        binary_prefix = f"{PREFIX}/{self.os_arch}/{self.compiler}/{self.package}"
+        return (
+            f"{binary_prefix}/{self.os_arch}-{self.compiler}-{self.package}"
+            f"-{self.build_hash}.spack"
+        )
+
+
+def get_build_hash(spec_json_sig_key: str) -> str:
+    """Return the build hash from the key of a spec.json.sig file."""
+    return spec_json_sig_key[: -len(".spec.json.sig")][-32:]
+
+
+def lookup_build(
+    spec_json_sig_key: str,
+    indexed_hashes: IndexedHashes,
+    build_jobs: dict[str, tuple[int, str, str]],
+) -> BuildRecord | None:
+    """
+    Resolve the build cache entry for the given S3 key.
+
+    Returns None if the entry should not be indexed, either because it has already been
+    uploaded to OpenSearch or because no gitlab job could be found for it.
+    """
+    logging.info(f'Looking up "{spec_json_sig_key}"...')
+
+    build_hash = get_build_hash(spec_json_sig_key)
+    shortened_build_hash = build_hash[:7]
+
+    # Check if a document with this hash already exists, and if so don't upload it.
+    if build_hash in indexed_hashes:
+        logging.info(
+            f"Skipping upload of record with build hash {build_hash} - already exists."
+        )
+        return None
+
+    if shortened_build_hash not in build_jobs:
+        logging.error(f"No gitlab job entry found for {spec_json_sig_key}")
+        return None
+
+    gitlab_job_id, compiler, os_arch = build_jobs[shortened_build_hash]
 
     package_regex = (
         rf"{PREFIX}\/{os_arch}-{compiler}-(.+)-[a-zA-Z0-9]{{32}}.spec.json.sig"
@@ -181,92 +705,374 @@ def fetch_and_upload_tarball(spec_json_sig_key: str):
         package = re.findall(package_regex, spec_json_sig_key)[0]
     except IndexError:
         logging.error(f'Regex "{package_regex}" failed to extract package name')
-        return
+        return None
 
-    # Check if a document with this hash already exists, and if so don't upload it.
-    res = requests.get(
-        f"{OPENSEARCH_ENDPOINT}/pipeline-logs*/_search",
-        data=json.dumps({"query": {"match": {"hash": build_hash}}}),
-        headers={"Content-Type": "application/json"},
-        auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
+    return BuildRecord(
+        key=spec_json_sig_key,
+        build_hash=build_hash,
+        package=package,
+        compiler=compiler,
+        os_arch=os_arch,
+        gitlab_job_id=gitlab_job_id,
     )
-    res.raise_for_status()
 
-    if res.json()["hits"]["total"]["value"] > 0:
-        logging.info(
-            f"Skipping upload of record with build hash {build_hash} - already exists."
-        )
-        return
 
-    binary_prefix = f"{PREFIX}/{os_arch}/{compiler}/{package}"
-    file_path = f"{binary_prefix}/{os_arch}-{compiler}-{package}-{build_hash}.spack"
+class _CountingReader:
+    """File-like wrapper that counts the bytes read from the underlying stream."""
 
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+# Total bytes read from tarballs compared to their total size, reported at the end of the run.
+tarball_stats: Counter[str] = Counter()
+tarball_stats_lock = threading.Lock()
+
+
+def fetch_build_files(record: BuildRecord) -> BuildRecord:
+    """
+    Stream the tarball for the given build and parse the build logs we're interested in.
+
+    The tarball is decompressed as it is downloaded, and the download is abandoned as soon as
+    spec.json and install_times.json have been read.
+    """
+    spack_dir = f"{record.package}-{record.build_hash}/.spack"
+    wanted = {
+        f"{spack_dir}/spec.json": "spec_json",
+        f"{spack_dir}/install_times.json": "install_times",
+    }
+
+    response = s3.get_object(Bucket=BUCKET, Key=record.tarball_key)
+    reader = _CountingReader(response["Body"])
     try:
-        # Download the tarball, extract it to a temp directory, parse the build logs we're
-        # interested in, and POST them to the OpenSearch cluster.
-        with NamedTemporaryFile("rb+") as f:
-            s3.download_fileobj(BUCKET, file_path, f)
-            with tarfile.open(
-                f.name, mode="r:gz"
-            ) as tar, TemporaryDirectory() as temp_dir:
-                tar.extract(f"{package}-{build_hash}/.spack/spec.json", path=temp_dir)
-                tar.extract(
-                    f"{package}-{build_hash}/.spack/install_times.json", path=temp_dir
-                )
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+            for member in tar:
+                if member.name not in wanted:
+                    continue
+                fd = tar.extractfile(member)
+                if fd is None:
+                    raise KeyError(f"{member.name} is not a regular file")
+                setattr(record, wanted.pop(member.name), json.load(fd))
+                if not wanted:
+                    break
+    finally:
+        response["Body"].close()
+        with tarball_stats_lock:
+            tarball_stats["bytes read"] += reader.bytes_read
+            tarball_stats["object bytes"] += response["ContentLength"]
 
-                spec_json = json.loads(
-                    (
-                        Path(temp_dir)
-                        / f"{package}-{build_hash}"
-                        / ".spack"
-                        / "spec.json"
-                    ).read_text()
-                )
-                install_times = json.loads(
-                    (
-                        Path(temp_dir)
-                        / f"{package}-{build_hash}"
-                        / ".spack"
-                        / "install_times.json"
-                    ).read_text()
-                )
+    if wanted:
+        raise KeyError(f"filename {', '.join(wanted)} not found")
+
+    return record
+
+
+def fetch_job_metadata(record: BuildRecord, cache: JobMetadataCache) -> BuildRecord:
+    """Get the metadata of the gitlab job that performed the given build."""
+    record.gitlab_job_metadata = get_gitlab_build_job_metadata(record.gitlab_job_id, cache)
+    return record
+
+
+def index_build(record: BuildRecord, indexer: BulkIndexer) -> BuildRecord:
+    """Queue the parsed build logs of the given build for upload to the OpenSearch cluster."""
+    upload_to_opensearch(
+        indexer,
+        record.build_hash,
+        record.spec_json,
+        record.install_times,
+        record.gitlab_job_metadata,
+    )
+    return record
+
+
+def log_key_error(item: str | BuildRecord, e: Exception):
+    """Log an error that occurred while processing a single S3 key."""
+    if isinstance(item, BuildRecord):
+        logging.error(f'Error occurred while processing Key "{item.key}"')
+        logging.error(f"Tarball S3 Key = {item.tarball_key}")
+    else:
+        logging.error(f'Error occurred while processing Key "{item}"')
+    logging.error(str(e))
+    if isinstance(e, requests.HTTPError):
+        try:
+            logging.error(str(e.response.json()) + "\n\n")
+        except json.JSONDecodeError:
+            logging.error(str(e.response.content) + "\n\n")
+
+
+# Marks the end of a stage's input. It is put back on the queue by each worker that sees it, so
+# every worker of the stage shuts down.
+_END_OF_INPUT = object()
 
-                upload_to_opensearch(build_hash, spec_json, install_times)
-    except Exception as e:
-        # Catch all exceptions and log error instead of crashing script
-        logging.error(f'Error occurred while processing Key "{spec_json_sig_key}"')
-        logging.error(f"Tarball S3 Key = {file_path}")
-        logging.error(str(e))
-        if isinstance(e, requests.HTTPError):
-            try:
-                logging.error(str(e.response.json()) + "\n\n")
-            except json.JSONDecodeError:
-                logging.error(str(e.response.content) + "\n\n")
-        return
 
+@dataclass
+class Stage:
+    """One step of the indexing pipeline, run by `workers` threads."""
 
-def main():
-    """Iterate over the entire S3 bucket and send any new build logs to OpenSearch."""
-    create_opensearch_index()
+    name: str
+    func: Callable[[Any], Any]
+    workers: int
 
-    all_pages = []
+
+def run_pipeline(items: Iterable[Any], stages: list[Stage], queue_size: int = QUEUE_SIZE):
+    """
+    Feed `items` through `stages`, each stage running in its own pool of threads.
+
+    Stages are connected by bounded queues, so producers block when the next stage falls behind.
+    The output of each stage is passed on to the next one, unless it is None, in which case
+    processing of that item stops. Exceptions raised by a stage are logged and only drop the item
+    that caused them.
+    """
+    inboxes = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stats: Counter[str] = Counter()
+    stats_lock = threading.Lock()
+    threads = []
+
+    for i, stage in enumerate(stages):
+        inbox = inboxes[i]
+        outbox = inboxes[i + 1] if i + 1 < len(stages) else None
+        running = [stage.workers]
+
+        def worker(stage=stage, inbox=inbox, outbox=outbox, running=running):
+            while True:
+                item = inbox.get()
+                if item is _END_OF_INPUT:
+                    inbox.put(_END_OF_INPUT)
+                    break
+                try:
+                    result = stage.func(item)
+                except Exception as e:
+                    # Catch all exceptions and log error instead of crashing script
+                    log_key_error(item, e)
+                    outcome = "failed"
+                else:
+                    outcome = "done" if result is not None else "skipped"
+                    if result is not None and outbox is not None:
+                        outbox.put(result)
+                with stats_lock:
+                    stats[f"{stage.name} {outcome}"] += 1
+
+            with stats_lock:
+                running[0] -= 1
+                last_worker = running[0] == 0
+            if last_worker and outbox is not None:
+                outbox.put(_END_OF_INPUT)
+
+        for n in range(stage.workers):
+            thread = threading.Thread(target=worker, name=f"{stage.name}-{n}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    for item in items:
+        inboxes[0].put(item)
+    inboxes[0].put(_END_OF_INPUT)
+
+    for thread in threads:
+        thread.join()
+
+    for stage in stages:
+        counts = ", ".join(
+            f"{stats[f'{stage.name} {outcome}']} {outcome}"
+            for outcome in ("done", "skipped", "failed")
+        )
+        print(f"{stage.name}: {counts}")
+
+
+def in_shard(build_hash: str, shard: tuple[int, int]) -> bool:
+    """Return whether the build belongs to shard `i` of `N`, given `shard` as (i, N)."""
+    index, count = shard
+    return zlib.crc32(build_hash.encode()) % count == index
+
+
+def list_spec_objects() -> Iterator[dict[str, Any]]:
+    """Yield every spec.json.sig object in the build cache as soon as its page is listed."""
     paginator = s3.get_paginator("list_objects_v2")
     for page in paginator.paginate(Bucket=BUCKET, Prefix=PREFIX):
-        contents = [
-            key["Key"]
-            for key in page["Contents"]
-            if key["Key"].endswith(".spec.json.sig")
-        ]
-        all_pages.extend(contents)
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".spec.json.sig"):
+                yield obj
+
+
+def report_build(record: BuildRecord) -> BuildRecord:
+    """Print the build that would be indexed, instead of indexing it."""
+    print(f"Would index {record.key} (gitlab job {record.gitlab_job_id})")
+    return record
+
+
+def _parse_datetime(value: str) -> datetime:
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO 8601 date: {value}")
+    # S3 timestamps are in UTC, so assume that for naive dates too.
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _parse_shard(value: str) -> tuple[int, int]:
+    try:
+        index, count = (int(n) for n in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must be given as i/N, got {value}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Index the build logs of the binaries in the spack build cache in OpenSearch"
+    )
+    parser.add_argument(
+        "--since",
+        type=_parse_datetime,
+        default=None,
+        help="Only process objects last modified at or after this date (ISO 8601, UTC)",
+    )
+    parser.add_argument(
+        "--until",
+        type=_parse_datetime,
+        default=None,
+        help="Only process objects last modified before this date (ISO 8601, UTC)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=_parse_shard,
+        default=None,
+        help="Only process shard i of N (e.g. 0/4), split deterministically by build hash",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="List the builds that would be indexed without downloading or indexing them",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        default=False,
+        help="Index builds even if they are already indexed, replacing the existing documents",
+    )
+    parser.add_argument(
+        "--lookup-workers",
+        type=int,
+        default=DB_LOOKUP_WORKERS,
+        help="Number of threads resolving S3 keys to builds",
+    )
+    parser.add_argument(
+        "--gitlab-workers",
+        type=int,
+        default=GITLAB_WORKERS,
+        help="Number of threads fetching gitlab job metadata",
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=FETCH_WORKERS,
+        help="Number of threads downloading tarballs",
+    )
+    parser.add_argument(
+        "--index-workers",
+        type=int,
+        default=INDEX_WORKERS,
+        help="Number of threads queueing documents for upload",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    """Iterate over the S3 bucket and send any new build logs to OpenSearch."""
+    args = parse_args(argv)
+    gitlab_session.mount("https://", HTTPAdapter(pool_maxsize=args.gitlab_workers))
+
+    if not args.dry_run:
+        create_opensearch_index()
+
+    if INDEXED_HASHES_SNAPSHOT:
+        indexed_hashes = IndexedHashes.load_snapshot(INDEXED_HASHES_SNAPSHOT)
+    else:
+        indexed_hashes = IndexedHashes()
+    indexed_hashes.load_from_opensearch()
+    print(f"{len(indexed_hashes)} build hashes are already indexed")
+
+    build_jobs = load_build_jobs()
+    print(f"Found gitlab jobs for {len(build_jobs)} build hashes")
+
+    objects = list_spec_objects()
+    if LISTING_WATERMARK:
+        # When reindexing, start from an empty watermark so every object is processed again.
+        if args.reindex:
+            watermark = ListingWatermark()
+        else:
+            watermark = ListingWatermark.load(LISTING_WATERMARK)
+        objects = watermark.filter(objects)
+
+    # Apply the filters after the watermark, which needs to see the whole listing.
+    keys = (
+        obj["Key"]
+        for obj in objects
+        if (args.since is None or obj["LastModified"] >= args.since)
+        and (args.until is None or obj["LastModified"] < args.until)
+        and (args.shard is None or in_shard(get_build_hash(obj["Key"]), args.shard))
+    )
+
+    lookup_stage = Stage(
+        "lookup",
+        partial(
+            lookup_build,
+            indexed_hashes=IndexedHashes() if args.reindex else indexed_hashes,
+            build_jobs=build_jobs,
+        ),
+        args.lookup_workers,
+    )
+
+    if args.dry_run:
+        run_pipeline(keys, [lookup_stage, Stage("report", report_build, 1)])
+        return
+
+    job_cache = JobMetadataCache()
+    try:
+        with BulkIndexer(
+            get_index_name(), indexed_hashes=indexed_hashes, replace_existing=args.reindex
+        ) as indexer:
+            run_pipeline(
+                keys,
+                [
+                    lookup_stage,
+                    Stage(
+                        "gitlab",
+                        partial(fetch_job_metadata, cache=job_cache),
+                        args.gitlab_workers,
+                    ),
+                    Stage("fetch", fetch_build_files, args.fetch_workers),
+                    Stage(
+                        "index", partial(index_build, indexer=indexer), args.index_workers
+                    ),
+                ],
+            )
+    finally:
+        job_cache.close()
+
+    if tarball_stats["object bytes"]:
+        print(
+            f"Read {tarball_stats['bytes read']} of {tarball_stats['object bytes']} tarball "
+            f"bytes ({100 * tarball_stats['bytes read'] / tarball_stats['object bytes']:.1f}%)"
+        )
 
-    # TODO: parallelize this
-    for spec_key_json in all_pages:
-        fetch_and_upload_tarball(spec_key_json)
+    if INDEXED_HASHES_SNAPSHOT:
+        indexed_hashes.save_snapshot(INDEXED_HASHES_SNAPSHOT)
+    if LISTING_WATERMARK:
+        watermark.update(indexed_hashes)
+        watermark.save(LISTING_WATERMARK)
 
 
 if __name__ == "__main__":
     try:
         main()
     finally:
-        cur.close()
         db_conn.close()